@@ -0,0 +1,152 @@
+# When the builds were last accessed. The access times are kept in memory and
+# appended in batches to a journal file in the registry directory, which is
+# shared by the worker processes. Every process reads what the others have
+# appended when it flushes its own batch. When the journal has grown much
+# larger than the number of builds, it is rewritten with the latest time of
+# every build that still exists. Access times appended by another process
+# while the journal is rewritten may be lost, which only makes a build look
+# a little older than it is.
+
+from builtins import object
+from threading import Lock, Thread
+import atexit
+import fcntl
+import logging
+import os
+import time
+
+from utils import UTF8
+try:
+    from config import Config
+except ImportError:
+    from config_default import Config
+
+log = logging.getLogger('pipeline.' + __name__)
+
+# The journal is rewritten when it has more than this many records, and
+# more than twice as many records as there are builds
+COMPACT_MIN_RECORDS = 10000
+
+# Seconds that the access time of a build without a directory is kept
+KEEP_MISSING = 60 * 60
+
+
+class AccessJournal(object):
+    """The last access time of every build, by build hash."""
+
+    def __init__(self, path, flush_interval):
+        self.path = path
+        self.lock_file = path + ".lock"
+        self.flush_interval = flush_interval
+        self.times = {}
+        # Access times that have not been written to the journal yet
+        self.pending = {}
+        # How far the journal has been read, and the inode it was read from
+        self.offset = 0
+        self.inode = None
+        self.records = 0
+        self.lock = Lock()
+        self.flusher = None
+
+    def touch(self, build_hash, t=None):
+        """Note that a build was accessed at time t, by default now."""
+        if t is None:
+            t = time.time()
+        with self.lock:
+            if t > self.times.get(build_hash, 0):
+                self.times[build_hash] = t
+                self.pending[build_hash] = t
+            self._start_flusher()
+
+    def get(self, build_hash):
+        """When a build was last accessed, or None if its access is not known."""
+        with self.lock:
+            t = self.times.get(build_hash)
+            if t is None:
+                # Perhaps accessed by another process
+                self._read()
+                t = self.times.get(build_hash)
+            return t
+
+    def flush(self):
+        """Append the pending access times to the journal, and read what other processes have appended."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            if pending:
+                data = "".join("%s %.3f\n" % (h, t) for h, t in pending.items()).encode(UTF8)
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+                try:
+                    os.write(fd, data)
+                finally:
+                    os.close(fd)
+            self._read()
+            if self.records > max(COMPACT_MIN_RECORDS, 2 * len(self.times)):
+                self._compact()
+
+    def _read(self):
+        """Read the records appended since the journal was last read. Must be called with the lock held."""
+        try:
+            f = open(self.path, "rb")
+        except IOError:
+            return
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            if inode != self.inode:
+                # Rewritten by a process, read it all
+                self.inode, self.offset, self.records = inode, 0, 0
+            f.seek(self.offset)
+            data = f.read()
+        # A record that is still being written is read the next time
+        end = data.rfind(b"\n") + 1
+        self.offset += end
+        for line in data[:end].decode(UTF8).splitlines():
+            parts = line.split(" ")
+            try:
+                build_hash, t = parts[0], float(parts[1])
+            except (IndexError, ValueError):
+                continue
+            self.records += 1
+            if t > self.times.get(build_hash, 0):
+                self.times[build_hash] = t
+
+    def _compact(self):
+        """Rewrite the journal with the builds that exist. Must be called with the lock held."""
+        with open(self.lock_file, "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # Another process is rewriting it
+                return
+            self._read()
+            # Builds accessed lately may not have a directory yet
+            recent = time.time() - KEEP_MISSING
+            self.times = dict((h, t) for h, t in self.times.items()
+                              if t > recent or os.path.isdir(os.path.join(Config.builds_dir, h)))
+            tmp_path = "%s.%s.tmp" % (self.path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                f.write("".join("%s %.3f\n" % (h, t) for h, t in self.times.items()).encode(UTF8))
+            os.rename(tmp_path, self.path)
+            log.info("Rewrote the access journal with %d builds, it had %d records", len(self.times), self.records)
+            self.inode = os.stat(self.path).st_ino
+            self.offset = os.path.getsize(self.path)
+            self.records = len(self.times)
+
+    def _start_flusher(self):
+        """Start the thread that flushes the journal. Must be called with the lock held."""
+        if self.flusher is None:
+            self.flusher = Thread(target=self._flush_regularly, name="access-journal")
+            self.flusher.daemon = True
+            self.flusher.start()
+            atexit.register(self.flush)
+
+    def _flush_regularly(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except:
+                log.exception("Could not flush the access journal")
+
+
+access_journal = AccessJournal(os.path.join(Config.registry_dir, "access.journal"),
+                               Config.access_journal_interval)
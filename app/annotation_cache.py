@@ -0,0 +1,174 @@
+# Content addressed cache of annotation files, shared between builds.
+#
+# The annotation files of an input file only depend on the contents of the
+# file and on the settings in the makefile. Settings that only select which
+# annotations are exported (the vrt_* variables) do not change them, so a text
+# that is resubmitted with e.g. an extra positional attribute can reuse the
+# annotations of the earlier build. The cached files are hard linked into the
+# annotations directory of a new build before make runs. They are read-only,
+# so that a make that rewrites a linked file in place fails instead of
+# changing the file for every build that shares it.
+
+from builtins import object
+import logging
+import os
+import re
+import shutil
+import stat
+import time
+import uuid
+
+from utils import make_hash, rmdir
+try:
+    from config import Config
+except ImportError:
+    from config_default import Config
+
+log = logging.getLogger('pipeline.' + __name__)
+
+# Makefile variables that only select the exported annotations
+OUTPUT_VARIABLES = ["vrt_columns_annotations", "vrt_columns", "vrt_structs_annotations", "vrt_structs"]
+
+# Annotation files that are results rather than annotations
+EXCLUDED_SUFFIXES = [".vrt"]
+
+READ_ONLY = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
+
+def settings_hash(makefile_contents):
+    """Hash the makefile without the variables that do not affect the annotation files."""
+    lines = []
+    for line in makefile_contents.split("\n"):
+        m = re.match(r"(\w+)\s*=", line)
+        if m and m.group(1) in OUTPUT_VARIABLES:
+            continue
+        lines.append(line)
+    return make_hash("\n".join(lines))
+
+
+class AnnotationCache(object):
+    """
+    Annotation files stored in one directory per entry. An entry is keyed by
+    the file name, the hash of the input text and the settings hash.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def entry_dir(self, filename, text_hash, settings_hash):
+        key = make_hash(filename, text_hash, settings_hash)
+        return os.path.join(self.directory, key[:2], key)
+
+    def link_into(self, annotations_dir, filename, text_hash, settings_hash):
+        """
+        Link the cached annotations of an input file into annotations_dir.
+        Return the number of linked files.
+        """
+        entry = self.entry_dir(filename, text_hash, settings_hash)
+        try:
+            cached_files = os.listdir(entry)
+        except OSError:
+            self.misses += 1
+            return 0
+
+        self.hits += 1
+        # The annotations must be newer than the original for make to keep
+        # them. The files are shared, so the times are set on the whole entry,
+        # and every file gets the same time, so that none of them looks out of
+        # date to make in any of the builds that share them.
+        now = time.time()
+        for suffix in cached_files:
+            try:
+                os.utime(os.path.join(entry, suffix), (now, now))
+            except OSError:
+                pass
+        linked = 0
+        for suffix in cached_files:
+            target = os.path.join(annotations_dir, filename + suffix)
+            if os.path.exists(target):
+                continue
+            try:
+                os.link(os.path.join(entry, suffix), target)
+            except OSError:
+                # The entry may have been pruned meanwhile
+                log.exception("Could not link cached annotation %s", target)
+                continue
+            linked += 1
+        log.info("Linked %d cached annotations for %s", linked, filename)
+        return linked
+
+    def store(self, annotations_dir, filename, text_hash, settings_hash):
+        """Store the annotation files of an input file, unless they are cached already."""
+        entry = self.entry_dir(filename, text_hash, settings_hash)
+        if os.path.isdir(entry):
+            return
+        prefix = filename + "."
+        tmp_entry = os.path.join(self.directory, ".tmp-" + uuid.uuid4().hex)
+        os.makedirs(tmp_entry)
+        try:
+            for annotation in os.listdir(annotations_dir):
+                if not annotation.startswith(prefix):
+                    continue
+                if any(annotation.endswith(s) for s in EXCLUDED_SUFFIXES):
+                    continue
+                source = os.path.join(annotations_dir, annotation)
+                if not os.path.isfile(source):
+                    continue
+                suffix = annotation[len(filename):]
+                try:
+                    os.link(source, os.path.join(tmp_entry, suffix))
+                except OSError:
+                    shutil.copy2(source, os.path.join(tmp_entry, suffix))
+                os.chmod(os.path.join(tmp_entry, suffix), READ_ONLY)
+            parent = os.path.dirname(entry)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            os.rename(tmp_entry, entry)
+            log.info("Stored annotations for %s in cache", filename)
+        except OSError:
+            # Probably stored by another build meanwhile
+            log.info("Could not store annotations for %s in cache", filename)
+            rmdir(tmp_entry)
+
+    def prune(self, max_age):
+        """
+        Remove entries that are not used by any build (no file has more than
+        one link) and that have not been used within max_age seconds.
+        Return the number of removed entries.
+        """
+        removed = 0
+        now = time.time()
+        for shard in os.listdir(self.directory):
+            shard_dir = os.path.join(self.directory, shard)
+            if shard.startswith(".tmp-"):
+                # Left by a process that died while storing an entry
+                try:
+                    if now - os.path.getmtime(shard_dir) > max_age:
+                        rmdir(shard_dir)
+                except OSError:
+                    pass
+                continue
+            if not os.path.isdir(shard_dir):
+                continue
+            for key in os.listdir(shard_dir):
+                entry = os.path.join(shard_dir, key)
+                try:
+                    # Entries may be stored or removed by other processes meanwhile
+                    stats = [os.stat(os.path.join(entry, f)) for f in os.listdir(entry)]
+                except OSError:
+                    continue
+                if any(st.st_nlink > 1 or now - st.st_mtime < max_age for st in stats):
+                    continue
+                rmdir(entry)
+                removed += 1
+        return removed
+
+
+if Config.annotation_cache_dir:
+    if not os.path.isdir(Config.annotation_cache_dir):
+        os.makedirs(Config.annotation_cache_dir)
+    annotation_cache = AnnotationCache(Config.annotation_cache_dir)
+else:
+    annotation_cache = None
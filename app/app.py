@@ -8,6 +8,11 @@ try:
 except ImportError:
     from config_default import Config
 
+# The other modules share this Config, so it must have all options before
+# they are imported
+from config_default import complete
+complete(Config)
+
 # Pythonpaths to the sparv python directory, and to the the directory of this script
 paths = [Config.sparv_python, Config.sparv_backend]
 for path in paths:
@@ -31,7 +36,23 @@ try:
     builds = resume_builds()
 except:
     log.exception("Failed to resume builds")
-    builds = dict()
+    from registry import registry as builds
+
+# Delete what is left in the trash, e.g. after a crash
+from trash import trash
+trash.empty()
+
+# Keep the builds within the disk budget
+from eviction import evictor
+evictor.start(builds, Config.eviction_interval)
+
+# Pack idle builds
+from cold_storage import cold_storage
+cold_storage.start(builds, Config.cold_check_interval)
+
+# Ping the catapults in the background
+from catapult import catapults
+catapults.start_probes(Config.catapult_probe_interval)
 
 
 def application(env, resp):
@@ -47,10 +68,6 @@ def application(env, resp):
         # Save builds in app
         app.config["BUILDS"] = builds
 
-        # Set global request counter
-        if "N_REQUESTS" not in app.config:
-            app.config["N_REQUESTS"] = 0
-
         return app(env, resp)
 
     except:
@@ -71,7 +88,4 @@ if __name__ == "__main__":
     from handlers import app
     # Save builds in app
     app.config["BUILDS"] = builds
-    # Set global request counter
-    if "N_REQUESTS" not in app.config:
-        app.config["N_REQUESTS"] = 0
     app.run(debug=True, threaded=True, host=Config.wsgi_host, port=Config.wsgi_port)
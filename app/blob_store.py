@@ -0,0 +1,114 @@
+# Content addressed store of the original texts of the builds.
+#
+# Builds of the same text with different settings have different build
+# hashes, but the same original text. The text is stored once, by the hash of
+# its contents, and hard linked into the original directory of every build.
+# The number of links of a stored file counts the builds that use it, so a
+# file with a single link is only held by the store and may be removed.
+# Removing it never affects a build, which keeps its own link.
+
+from builtins import object
+import errno
+import logging
+import os
+import time
+import uuid
+
+try:
+    from config import Config
+except ImportError:
+    from config_default import Config
+
+log = logging.getLogger('pipeline.' + __name__)
+
+
+class BlobStore(object):
+    """Files keyed by the hash of their contents, in one subdirectory per two first hash characters."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def blob_path(self, text_hash):
+        return os.path.join(self.directory, text_hash[:2], text_hash)
+
+    def link_text(self, text_hash, target, text):
+        """Link the stored text with text_hash to target, storing text first if it is missing."""
+        def write(path):
+            with open(path, 'w') as f:
+                f.write(text)
+        self._link(text_hash, target, write)
+
+    def link_file(self, text_hash, target, source):
+        """Link the stored file with text_hash to target, storing the file source first if it is missing."""
+        self._link(text_hash, target, lambda path: os.link(source, path))
+
+    def _link(self, text_hash, target, make):
+        blob = self.blob_path(text_hash)
+        if os.path.exists(blob):
+            self.hits += 1
+        else:
+            self.misses += 1
+        # The stored file may be pruned before it is linked, then it is stored again
+        for attempt in range(3):
+            if not os.path.exists(blob):
+                tmp_path = os.path.join(self.directory, ".tmp-" + uuid.uuid4().hex)
+                make(tmp_path)
+                parent = os.path.dirname(blob)
+                if not os.path.isdir(parent):
+                    try:
+                        os.makedirs(parent)
+                    except OSError:
+                        # Made by another build meanwhile
+                        pass
+                # Replaces a file with the same contents, stored meanwhile
+                os.rename(tmp_path, blob)
+            try:
+                os.link(blob, target)
+                return
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    # Replace the file, e.g. one left by an earlier attempt
+                    tmp_path = "%s.%s.tmp" % (target, uuid.uuid4().hex[:8])
+                    os.link(blob, tmp_path)
+                    os.rename(tmp_path, target)
+                    return
+                if e.errno != errno.ENOENT or attempt == 2:
+                    raise
+
+    def prune(self, max_age):
+        """
+        Remove stored files that no build uses, and that have not been linked
+        or unlinked within max_age seconds. Return the number of removed files.
+        """
+        removed = 0
+        now = time.time()
+        for shard in os.listdir(self.directory):
+            shard_dir = os.path.join(self.directory, shard)
+            if not os.path.isdir(shard_dir):
+                # Left by a process that died while storing a file
+                if shard.startswith(".tmp-") and now - os.path.getmtime(shard_dir) > max_age:
+                    os.remove(shard_dir)
+                continue
+            for blob in os.listdir(shard_dir):
+                path = os.path.join(shard_dir, blob)
+                try:
+                    st = os.stat(path)
+                    # Linking and unlinking change the ctime
+                    if st.st_nlink == 1 and now - st.st_ctime > max_age:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    continue
+        if removed:
+            log.info("Removed %d original texts that no build uses", removed)
+        return removed
+
+
+if Config.blob_store_dir:
+    if not os.path.isdir(Config.blob_store_dir):
+        os.makedirs(Config.blob_store_dir)
+    blob_store = BlobStore(Config.blob_store_dir)
+else:
+    blob_store = None
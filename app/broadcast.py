@@ -0,0 +1,84 @@
+# Broadcasting of status changes and increment messages from a build to the
+# clients that are watching it.
+
+from builtins import object
+from threading import Condition
+
+from enums import Message
+
+
+class ProgressHub(object):
+    """
+    Keeps the latest status and the latest increment message of a build.
+
+    Publishing a change only updates the latest state and wakes the
+    listeners, so it costs the same no matter how many listeners there are.
+    A listener that is too slow to see every increment gets the latest one
+    instead of a backlog, so no memory is spent on buffers.
+    """
+
+    def __init__(self):
+        self.cond = Condition()
+        self.status = None
+        self.status_version = 0
+        self.increment = None
+        self.increment_version = 0
+        self.listeners = 0
+
+    def publish_status(self, status):
+        with self.cond:
+            self.status = status
+            self.status_version += 1
+            self.cond.notify_all()
+
+    def publish_increment(self, msg):
+        with self.cond:
+            self.increment = msg
+            self.increment_version += 1
+            self.cond.notify_all()
+
+    def listen(self):
+        """Register a new listener. It must be closed when it is no longer used."""
+        with self.cond:
+            self.listeners += 1
+            return Listener(self)
+
+
+class Listener(object):
+    """A listener that receives the changes published after it was registered."""
+
+    def __init__(self, hub):
+        self.hub = hub
+        self.status_version = hub.status_version
+        self.increment_version = hub.increment_version
+        self.closed = False
+
+    def _changed(self):
+        return (self.hub.status_version != self.status_version or
+                self.hub.increment_version != self.increment_version)
+
+    def get(self, timeout=None):
+        """
+        Wait for changes, and return a list of messages: the latest increment
+        message followed by the latest status, for the ones that have changed.
+        Return an empty list if nothing changed within timeout seconds.
+        """
+        hub = self.hub
+        with hub.cond:
+            if not self._changed():
+                hub.cond.wait_for(self._changed, timeout)
+            messages = []
+            if hub.increment_version != self.increment_version:
+                self.increment_version = hub.increment_version
+                messages.append((Message.Increment, hub.increment))
+            if hub.status_version != self.status_version:
+                self.status_version = hub.status_version
+                messages.append((Message.StatusChange, hub.status))
+            return messages
+
+    def close(self):
+        """Unregister this listener."""
+        with self.hub.cond:
+            if not self.closed:
+                self.closed = True
+                self.hub.listeners -= 1
@@ -7,67 +7,154 @@ standard_library.install_aliases()
 from builtins import str, object
 from xml.sax.saxutils import escape
 
+from threading import Lock, Timer
 import time
 import os
+import json
 import logging
+import signal
 import zipfile
-import io
 import re
 
 try:
     from config import Config
 except ImportError:
     from config_default import Config
-from enums import Status, Message, finished
-from make_makefile import makefile
-from utils import make_hash, make, mkdir, rmdir, ERROR_MSG, make_trace, UTF8
-from subprocess import call
+from enums import Status, finished
+from access_journal import access_journal
+from annotation_cache import annotation_cache, settings_hash
+from blob_store import blob_store
+from broadcast import ProgressHub
+from cold_storage import ReadLock
+from catapult import catapults
+from dryrun_cache import dryrun_cache
+from make_makefile import clean_settings, makefile
+from make_supervisor import MakeSupervisor
+from metrics import metrics
+from scheduler import scheduler
+from trash import trash
+from utils import make_hash, make, mkdir, ERROR_MSG, make_trace, UTF8
 
 log = logging.getLogger('pipeline.' + __name__)
 
+# Runs annotation steps while logging their times, see timings.py
+STEP_TIMER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'time_step.sh')
+
+# Size of the chunks in which results are read from disk
+RESULT_CHUNK_SIZE = 64 * 1024
+
+# Seconds that a cancelled make gets to stop before it is killed
+KILL_GRACE = 5
+
+
+# Matches a line of make output that calls the python interpreter of any
+# catapult, capturing the first four arguments
+STEP_LINE = re.compile("(?:%s)" % "|".join(re.escape(i) for i in catapults.interpreters()) +
+                       r"\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)")
+
+
+def command_name(line):
+    """
+    Get the annotation command from a line of make output, or None if the
+    line does not call the python interpreter.
+    """
+    m = STEP_LINE.search(line)
+    if m is None:
+        return None
+    return m.group(2) + " " + m.group(3) if "--" in m.group(4) else m.group(2)
+
+
+class BuildCancelled(Exception):
+    """Raised in the build thread when a build has been cancelled."""
+
+
+def kill_process_group(process):
+    """Terminate a make process with all its children, and kill them if they do not stop in time."""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        return
+
+    def kill():
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    t = Timer(KILL_GRACE, kill)
+    t.daemon = True
+    t.start()
+
 
 class Build(object):
     """
     The Build class.
 
-    Register yourself with a queue to the queues list to get messages
+    Register yourself as a listener on the hub to get messages
     about status changes and incremental messages.
     """
 
-    def __init__(self, text, settings, files=None, init_from_hash=None, resuming=False):
+    def __init__(self, text, settings, files=None, init_from_hash=None, resuming=False, batch=False):
         """
         Create the necessary directories and the makefile for this
-        text and the JSON settings.
+        text and the JSON settings. For file uploads, files is an
+        UploadSpool holding the uploaded files. A batch build is a file
+        build whose files are built and judged one by one, see file_result.
         """
         self.status = None
-        self.queues = []
+        self.status_change_time = time.time()
+        self.hub = ProgressHub()
+        # The registry that shares the state of this build, if this process runs it
+        self.registry = None
+        self.trace, self.stdout, self.stderr = ("", "", "")
+        # Why the build was cancelled, a key of ERROR_MSG
+        self.cancel_reason = None
+        # The make process that is running, and the lock for starting and cancelling it
+        self.current_process = None
+        self.process_lock = Lock()
+        self.started_time = None
+        # When a client was last waiting for the build
+        self.last_watched = None
         self.files = files
+        self.batch = batch
+        self.resuming = resuming
+        self.linked_annotations = 0
+        # Whether the build directory existed before the files were made, e.g.
+        # left by an earlier incarnation or a cancelled run, so that it may be
+        # partly built
+        self.reused_directory = False
+        # Status changes as (status name, time), kept in the manifest
+        self.transitions = []
+        self.manifest = None
 
         if init_from_hash:
             self.build_hash = init_from_hash
+            self.manifest = self.read_manifest()
+            if self.manifest is not None:
+                self.transitions = self.manifest["transitions"]
+                self.batch = self.manifest.get("batch", False)
             # File upload:
             if init_from_hash.endswith(Config.fileupload_ext):
-                original_dir = os.path.join(os.path.join(Config.builds_dir, self.build_hash), 'original')
-                filelist = []
-                for root, dirs, files in os.walk(original_dir):
-                    for infile in files:
-                        with open(os.path.join(root, infile), "r") as f:
-                            text = f.read()
-                        fname = infile[:infile.rfind(".")]
-                        filelist.append((fname, text))
-                self.files = filelist
+                if self.manifest is not None:
+                    self.files = [f["name"] for f in self.manifest["files"]]
+                else:
+                    original_dir = os.path.join(os.path.join(Config.builds_dir, self.build_hash), 'original')
+                    filelist = []
+                    for root, dirs, files in os.walk(original_dir):
+                        for infile in files:
+                            filelist.append(infile[:infile.rfind(".")])
+                    self.files = filelist
             else:
                 self.text = text
                 self.filename = 'text'
 
         else:
             self.makefile_contents = makefile(settings)
-            self.settings = settings
-            # File upload
+            self.settings = clean_settings(settings)
+            # File upload, spooled to disk
             if files:
-                self.text = "\n".join(text for _fn, text in files)
-                filenames = " ".join(fn for fn, _text in files)
-                self.build_hash = make_hash(self.text, self.makefile_contents, filenames) + Config.fileupload_ext
+                self.upload = files
+                self.files = files.names
+                self.build_hash = files.build_hash(self.makefile_contents) + Config.fileupload_ext
             else:
                 self.text = text
                 self.filename = 'text'
@@ -82,12 +169,15 @@ class Build(object):
 
         # Files
         self.makefile = os.path.join(self.directory, 'Makefile')
+        self.manifest_file = os.path.join(self.directory, 'manifest.json')
         self.warnings_log_file = os.path.join(self.directory, 'warnings.log')
+        self.timings_file = os.path.join(self.directory, 'timings.log')
+        # Only written by earlier versions, see access()
         self.accessed_file = os.path.join(self.directory, 'accessed')
         self.settings_file = os.path.join(self.directory, 'settings.json')
         self.zipfpath = os.path.join(self.directory, "export.zip")
         self.zipfile = "export.zip"
-        if not files:
+        if not self.files:
             self.text_file = os.path.join(self.original_dir, self.filename + '.xml')
             self.result_file_path = os.path.join(self.export_dir, self.filename + '.xml')
             self.result_file = self.filename + '.xml'
@@ -103,34 +193,54 @@ class Build(object):
         self.steps = 0
         self.step = 0
 
+        # Position in the build queue and expected waiting time in seconds
+        self.queue_position = 0
+        self.expected_wait = 0
+
     def access(self, resuming=False):
         """
-        Update the access time of this build.
-        If resuming=True just get the time stamp of the build.
+        Update the access time of this build in the access journal.
+        If resuming=True just make sure that the access time is known.
         """
         if not resuming:
-            call(['touch', self.accessed_file])
-            self.accessed_time = time.time()
-        else:
-            if os.path.exists(self.accessed_file):
-                self.accessed_time = os.path.getmtime(self.accessed_file)
-            else:
-                self.accessed_time = time.time()
+            access_journal.touch(self.build_hash)
+        elif access_journal.get(self.build_hash) is None:
+            # Builds accessed before the journal was kept have an accessed file
+            try:
+                access_journal.touch(self.build_hash, os.path.getmtime(self.accessed_file))
+            except OSError:
+                access_journal.touch(self.build_hash)
+
+    def hot_files(self):
+        """
+        A lock that keeps the files of this build out of cold storage while
+        they are read. They are unpacked when it is acquired, if need be.
+        """
+        return ReadLock(self.directory)
+
+    @property
+    def accessed_time(self):
+        """When this build was last accessed."""
+        return access_journal.get(self.build_hash)
 
     def increment_msg(self):
         """The current increment message"""
+        if self.status == Status.Queued:
+            return ('<increment command="%s" step="%s" steps="%s" queue-position="%s" expected-wait="%s"/>\n'
+                    % (self.command, self.step, self.steps, self.queue_position, self.expected_wait))
         return '<increment command="%s" step="%s" steps="%s"/>\n' % (self.command, self.step, self.steps)
 
-    def send_to_all(self, msg):
-        """Send a message to all listeners."""
-        for q in self.queues:
-            q.put(msg)
-
     def change_status(self, status):
         """Change the status and notify all listeners."""
         self.status = status
         self.status_change_time = time.time()
-        self.send_to_all((Message.StatusChange, self.status))
+        if self.registry is not None:
+            metrics.inc("build_status_changes_total", (("status", Status.lookup[status]),))
+            self.transitions.append([Status.lookup[status], self.status_change_time])
+            if status != Status.Deleted:
+                self.write_manifest()
+            self.registry.save(self)
+        self.hub.publish_status(self.status)
         log.info("%s: Status changed to %s", self.build_hash, Status.lookup[self.status])
 
     def change_step(self, new_cmd=None, new_step=None, new_steps=None):
@@ -144,7 +254,86 @@ class Build(object):
             self.command = new_cmd
         if new_steps is not None:
             self.steps = new_steps
-        self.send_to_all((Message.Increment, self.increment_msg()))
+        if self.registry is not None:
+            self.registry.save(self)
+        self.hub.publish_increment(self.increment_msg())
+
+    def change_queue_position(self, position, expected_wait):
+        """
+        Change the position in the build queue, and notify all listeners
+        that the increment has been changed.
+        """
+        self.queue_position = position
+        self.expected_wait = expected_wait
+        if self.status != Status.Queued:
+            self.change_status(Status.Queued)
+        self.change_step()
+
+    def write_manifest(self):
+        """
+        Write a summary of the state of this build to the manifest file.
+        The manifest is replaced atomically, so it is never seen half written.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        names = self.files if self.files else [self.filename]
+        files = []
+        for name in names:
+            path = os.path.join(self.original_dir, name + '.xml')
+            files.append({"name": name, "size": os.path.getsize(path) if os.path.isfile(path) else None})
+        results = {}
+        if finished(self.status) and hasattr(self, 'fmt'):
+            out_files = self.out_files if self.files else [self.out_file]
+            for path in out_files + [self.zipfpath]:
+                if os.path.isfile(path):
+                    results[os.path.relpath(path, self.directory)] = os.path.getsize(path)
+        warnings = getattr(self, 'warnings', None)
+        manifest = {
+            "hash": self.build_hash,
+            "status": Status.lookup[self.status] if self.status is not None else None,
+            "transitions": self.transitions,
+            "fmt": getattr(self, 'fmt', None),
+            "batch": self.batch,
+            "files": files,
+            "steps": self.steps,
+            "warnings": len(warnings.split("\n")) if warnings else 0,
+            "results": results,
+        }
+        tmp_path = "%s.%s.tmp" % (self.manifest_file, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.rename(tmp_path, self.manifest_file)
+        self.manifest = manifest
+
+    def read_manifest(self):
+        """Read the manifest of an existing build, or return None if it has none."""
+        try:
+            with open(os.path.join(Config.builds_dir, self.build_hash, 'manifest.json'), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def restore_status(self):
+        """
+        Restore the status of a finished build that is not registered, from
+        its manifest, or from its result files if it has no manifest.
+        Return True if the build has finished.
+        """
+        if self.manifest is not None:
+            status = getattr(Status, self.manifest["status"] or "Init")
+            if not finished(status):
+                return False
+            self.set_outputs(self.manifest["fmt"] or 'xml')
+            self.status = status
+            self.status_change_time = self.transitions[-1][1]
+            self.steps = self.manifest["steps"]
+        else:
+            self.set_outputs('xml')
+            if not self.result_exists():
+                return False
+            self.status = Status.Done
+        self.read_warnings()
+        return True
 
     def get_settings(self):
         # Open settings file
@@ -160,7 +349,7 @@ class Build(object):
         # for file upload
         if self.files:
             original = []
-            for filename, _text in self.files:
+            for filename in self.files:
                 original.append(filename + ".xml")
             original = "files='%s'" % ", ".join(original)
         else:
@@ -173,6 +362,12 @@ class Build(object):
                 original = ""
         return original
 
+    def original_hashes(self):
+        """List the file names and text hashes of the input files of a new build."""
+        if self.files:
+            return [(filename, self.upload.text_hashes[filename]) for filename in self.files]
+        return [(self.filename, make_hash(self.text))]
+
     def make_files(self):
         """
         Make the files for building this corpus:
@@ -180,59 +375,168 @@ class Build(object):
         """
         self.change_status(Status.Init)
         self.access()
+        self.reused_directory = os.path.isdir(self.directory)
 
         # Make directories
         # map(mkdir, [self.directory, self.original_dir, self.annotations_dir, self.export_dir])
-        for i in [self.directory, self.original_dir, self.annotations_dir, self.export_dir]:
+        for i in [self.directory, self.annotations_dir, self.export_dir]:
             mkdir(i)
 
         # Make makefile
         with open(self.makefile, 'w') as f:
-            f.write(makefile(self.settings))
+            f.write(self.makefile_contents)
 
         # Write settings file
         with open(self.settings_file, 'w') as f:
-            import json
             f.write(json.dumps(self.settings, indent=2))
 
         # for file upload
         if self.files:
-            for filename, text in self.files:
-                infile = os.path.join(self.original_dir, filename + ".xml")
-                with open(infile, 'w') as f:
-                    f.write(text)
+            self.upload.move_to(self.original_dir)
 
         else:
+            mkdir(self.original_dir)
             if os.path.isfile(self.text_file):
                 # This file has probably been built by a previous incarnation of the pipeline
                 # (index.wsgi script has been restarted)
                 log.info("File exists and is not rewritten: %s" % self.build_hash)
+            elif blob_store is not None:
+                blob_store.link_text(make_hash(self.text), self.text_file, self.text)
             else:
                 with open(self.text_file, 'w') as f:
                     f.write(self.text)
 
+        # Reuse the annotations of earlier builds of the same texts
+        if annotation_cache is not None:
+            makefile_hash = settings_hash(self.makefile_contents)
+            for filename, text_hash in self.original_hashes():
+                self.linked_annotations += annotation_cache.link_into(
+                    self.annotations_dir, filename, text_hash, makefile_hash)
+
+        self.write_manifest()
+
     def remove_files(self):
-        """Remove the files associated with this build."""
+        """
+        Move the files associated with this build to the trash. Return the
+        trashed directory, to be deleted with trash.delete, or None if the
+        build has no files.
+        """
         self.change_status(Status.Deleted)
         log.info("Removing files")
-        rmdir(self.directory)
+        return trash.move(self.directory)
 
-    def _run(self, fmt):
+    def set_outputs(self, fmt):
+        """Set the paths of the parsed texts and the result files for format fmt."""
+        self.fmt = fmt
+        if self.files:
+            self.out_files = []
+            self.textfiles = []
+            for filename in self.files:
+                self.out_files.append(os.path.join(self.export_dir, filename + '.xml'))
+                self.textfiles.append(os.path.join(self.annotations_dir, filename + '.@TEXT'))
+        else:
+            self.textfile = os.path.join(self.annotations_dir, self.filename + '.@TEXT')
+            if fmt == 'vrt' or fmt == 'cwb':
+                self.out_file = os.path.join(self.annotations_dir, self.filename + '.vrt')
+            else:
+                self.out_file = os.path.join(self.export_dir, self.filename + '.xml')
+
+    def result_exists(self):
+        """Check if the result files of this build exist. set_outputs must be called first."""
+        if self.files:
+            return os.path.isfile(self.zipfpath) or all(os.path.isfile(f) for f in self.out_files)
+        return os.path.isfile(self.out_file)
+
+    def file_result(self, filename):
         """
-        Run make, sending increments, and eventually change status to done.
+        The result of one input file of a finished file build. Return
+        (contents, None), or (None, error message) if there is no result.
         """
-        def send_warnings():
+        if self.status == Status.ParseError:
+            return None, ERROR_MSG["parsing_error"]
+        elif self.status == Status.Cancelled:
+            return None, ERROR_MSG[self.cancel_reason or "cancelled"]
+        elif self.status != Status.Done:
+            return None, ERROR_MSG["no_result"]
+
+        # A file of a batch build may have failed on its own
+        if not os.path.isfile(os.path.join(self.annotations_dir, filename + '.@TEXT')):
+            return None, ERROR_MSG["parsing_error"]
+        # Check for empty input (e.g. "<text></text>")
+        wordfile = os.path.join(self.annotations_dir, filename + '.token.word')
+        if not os.path.isfile(wordfile) or os.path.getsize(wordfile) == 0:
+            return None, ERROR_MSG["empty_input"]
+        try:
+            with open(os.path.join(self.export_dir, filename + '.xml'), 'rb') as f:
+                return f.read(), None
+        except IOError:
+            return None, ERROR_MSG["make_error" if self.batch else "missing_file"]
+
+    def cancel(self, reason):
+        """
+        Stop this build for reason (a key of ERROR_MSG). A waiting build is
+        taken out of the queue, a running one has its make process group killed.
+        """
+        with self.process_lock:
+            if finished(self.status) or self.cancel_reason is not None:
+                return
+            self.cancel_reason = reason
+            process = self.current_process
+        log.info("%s: Cancelling build (%s)", self.build_hash, reason)
+        if scheduler.cancel(self):
+            self.change_status(Status.Cancelled)
+        elif process is not None and process.poll() is None:
+            kill_process_group(process)
+
+    def start_make(self, args):
+        """Start make, unless the build has been cancelled."""
+        with self.process_lock:
+            if self.cancel_reason is not None:
+                raise BuildCancelled(self.cancel_reason)
+            self.current_process = make(args)
+            return self.current_process
+
+    def call_make(self, args):
+        """Run make to the end. Return its stdout and stderr."""
+        stdout, stderr = self.start_make(args).communicate("")
+        if self.cancel_reason is not None:
+            raise BuildCancelled(self.cancel_reason)
+        return stdout, stderr
+
+    def read_warnings(self):
+        """Read the warnings of this build from the warnings log."""
+        try:
+            with open(self.warnings_log_file, "r") as f:
+                self.warnings = self.fix_warnings(f.read().rstrip())
+
+        except IOError:
+            self.warnings = None
+
+    def language(self):
+        """The language of the texts of this build."""
+        settings = getattr(self, "settings", None)
+        if settings is None:
             try:
-                with open(self.warnings_log_file, "r") as f:
-                    self.warnings = self.fix_warnings(f.read().rstrip())
+                settings = json.loads(self.get_settings())
+            except ValueError:
+                settings = {}
+        return settings.get("lang") or "sv"
 
-            except IOError:
-                self.warnings = None
+    def _run(self, fmt, catapult):
+        """
+        Run make with the annotation steps sent to catapult, sending
+        increments, and eventually change status to done.
+        """
+        self.set_outputs(fmt)
+        self.started_time = time.time()
 
+        interpreter = catapult.interpreter
+        if Config.step_timing:
+            interpreter = "%s %s %s" % (STEP_TIMER, self.timings_file, interpreter)
         make_settings = ['-C', self.directory,
                          'dir_chmod=777',
                          '-j', str(Config.processes),
-                         "python=%s" % Config.python_interpreter]
+                         "python=%s" % interpreter]
 
         # First set up some environment variables
         os.environ['SPARV_MODELS'] = Config.sparv_models
@@ -244,53 +548,62 @@ class Build(object):
         # For file upload
         if self.files:
             make_settings = ['export'] + make_settings
-            self.out_files = []
-            self.textfiles = []
-            for filename, _text in self.files:
-                self.out_files.append(os.path.join(self.export_dir, filename + '.xml'))
-                self.textfiles.append(os.path.join(self.annotations_dir, filename + '.@TEXT'))
+            if self.batch:
+                # Keep building the other files when one of them fails
+                make_init.append('-k')
+                make_settings.append('-k')
 
             # Try to parse files first
-            stdout, stderr = make(make_init).communicate("")
+            stdout, stderr = self.call_make(make_init)
             self.change_status(Status.Parsing)
-            # Send warnings
-            for out_file in self.textfiles:
-                if not os.path.exists(out_file):
-                    send_warnings()
-                    self.change_status(Status.ParseError)
-                    log.error(ERROR_MSG["parsing_error"])
-                    return
+            # Send warnings. A batch build fails only if no file could be parsed.
+            parsed = [os.path.exists(out_file) for out_file in self.textfiles]
+            if not all(parsed) and not (self.batch and any(parsed)):
+                self.read_warnings()
+                self.change_status(Status.ParseError)
+                log.error(ERROR_MSG["parsing_error"])
+                return
 
         else:
             # Try to parse file first
-            self.textfile = os.path.join(self.annotations_dir, self.filename + '.@TEXT')
-            stdout, stderr = make(make_init).communicate("")
+            stdout, stderr = self.call_make(make_init)
             self.change_status(Status.Parsing)
             if stderr:
-                send_warnings()
-                self.change_status(Status.Error)
+                self.read_warnings()
                 self.stderr = stderr.rstrip().decode("UTF-8")
+                self.change_status(Status.Error)
                 log.error(ERROR_MSG["make_error"])
                 return
             # Send warnings
             if not os.path.exists(self.textfile):
-                send_warnings()
+                self.read_warnings()
                 self.change_status(Status.ParseError)
                 log.error(ERROR_MSG["parsing_error"])
                 return
 
             if fmt == 'vrt' or fmt == 'cwb':
                 make_settings = [fmt] + make_settings
-                self.out_file = os.path.join(self.annotations_dir, self.filename + '.vrt')
             else:
                 make_settings = ['export'] + make_settings
-                self.out_file = os.path.join(self.export_dir, self.filename + '.xml')
 
-        # Do a dry run to get the number of invocations that will be made
-        stdout, stderr = make(make_settings + ['--dry-run']).communicate("")
-        self.stderr = stderr.decode(UTF8)
-        assert(self.stderr == "")
-        steps = stdout.decode(UTF8).count(Config.python_interpreter)
+        # Get the number of invocations that will be made, from the cache or
+        # from a dry run. Resumed builds, builds with cached annotations and
+        # builds made in an existing directory may be partly built, so they
+        # are always dry run.
+        use_dryrun_cache = not self.resuming and not self.linked_annotations and not self.reused_directory
+        steps = None
+        if use_dryrun_cache:
+            cache_key = dryrun_cache.key(self.makefile_contents, make_settings[0],
+                                         len(self.files) if self.files else 1)
+            steps = dryrun_cache.get(cache_key)
+        if steps is None:
+            stdout, stderr = self.call_make(make_settings + ['--dry-run'])
+            self.stderr = stderr.decode(UTF8)
+            assert(self.stderr == "")
+            stdout = stdout.decode(UTF8)
+            steps = stdout.count(catapult.interpreter)
+            if use_dryrun_cache:
+                dryrun_cache.put(cache_key, steps)
 
         # No remote installations allowed
         os.environ['remote_cwb_datadir'] = "null"
@@ -298,24 +611,22 @@ class Build(object):
         os.environ['remote_host'] = "null"
 
         # Now, make!
-        self.make_process = make(make_settings)
+        self.make_process = self.start_make(make_settings)
+        self.make_output = MakeSupervisor(self.make_process)
         self.change_status(Status.Running)
 
-        # Process the output from make
+        # Process the output from make, step by step
         self.change_step(new_cmd="", new_step=0, new_steps=steps + 1)
         step = 0
-        for line in iter(self.make_process.stdout.readline, b''):
-            line = line.decode(UTF8)
+        for line in self.make_output:
             self.make_out.append(line)
-            if Config.python_interpreter in line:
+            name = command_name(line)
+            if name is not None:
                 step += 1
-                argstring = line.split(Config.python_interpreter)[1]
-                arguments = argstring.lstrip().split()
-                command = " ".join(arguments[1:3]) if "--" in arguments[3] else arguments[1]
-                self.change_step(new_step=step, new_cmd=command)
+                self.change_step(new_step=step, new_cmd=name)
         self.change_step(new_cmd="", new_step=step + 1)
 
-        send_warnings()
+        self.read_warnings()
 
         # The corpus should now be in self.out_file
         # Its contents are not stored because of memory reasons
@@ -323,7 +634,21 @@ class Build(object):
 
         self.make_process.stdout.close()
         self.make_process.stderr.close()
-        self.make_process.wait()
+        returncode = self.make_process.wait()
+        if self.cancel_reason is not None:
+            raise BuildCancelled(self.cancel_reason)
+
+        # Create the downloadable zip file before anyone is told that the build is done
+        if self.files:
+            self.zip_result()
+
+        # Share the annotations with later builds of the same texts, unless
+        # they may have been left half written by an earlier run
+        if annotation_cache is not None and returncode == 0 and not self.resuming and \
+                not self.reused_directory:
+            makefile_hash = settings_hash(self.makefile_contents)
+            for filename, text_hash in self.original_hashes():
+                annotation_cache.store(self.annotations_dir, filename, text_hash, makefile_hash)
 
         self.change_status(Status.Done)
 
@@ -331,19 +656,30 @@ class Build(object):
         """Run make, catching errors."""
         self.make_process = None
         self.trace, self.stdout, self.stderr = ("", "", "")
+        catapult = catapults.acquire(self.language())
+        log.info("%s: Running on the catapult at %s", self.build_hash, catapult.socket_file)
+        started = time.time()
 
         try:
-            self._run(fmt)
+            self._run(fmt, catapult)
+        except BuildCancelled:
+            log.info("%s: Build stopped (%s)", self.build_hash, self.cancel_reason)
+            self.change_status(Status.Cancelled)
         except:
             self.trace = make_trace()
             log.exception(ERROR_MSG["make_error"])
-            self.stdout = "".join(self.make_out)
             if self.make_process:
-                self.stderr = self.make_process.stderr.read().rstrip()
+                # Let make finish, keeping what it still writes
+                for line in self.make_output:
+                    self.make_out.append(line)
+                self.stderr = self.make_output.stderr().rstrip()
                 self.make_process.stdout.close()
                 self.make_process.stderr.close()
                 self.make_process.wait()
+            self.stdout = "".join(self.make_out)
             self.change_status(Status.Error)
+        finally:
+            catapults.release(catapult, time.time() - started)
 
     def fix_warnings(self, warnings_str):
         """Remove confusing stuff from warnings log."""
@@ -357,98 +693,97 @@ class Build(object):
         return "\n".join(lines)
 
     def zip_result(self):
-        """Create a zip archive of all the result files in the export.original folder."""
+        """
+        Create a zip archive of all the result files in the export.original folder,
+        unless it exists already. The archive is written in one pass to a
+        temporary file and renamed into place, so that a partly written
+        archive is never served.
+        """
+        if os.path.isfile(self.zipfpath):
+            return self.zipfpath
         log.info("Creating zip file...")
-        assert(finished(self.status))
-        if self.status == Status.Done:
-            if os.listdir(self.export_dir):
-                zipf = zipfile.ZipFile(self.zipfpath, 'w', compression=zipfile.ZIP_DEFLATED)
-                filelike = io.BytesIO()
-                with zipfile.ZipFile(filelike, 'w', compression=zipfile.ZIP_DEFLATED) as zipflike:
-                    for root, _dirs, files in os.walk(self.export_dir):
-                        for xmlfile in files:
-                            newfilename = xmlfile[:-4] + "_annotated.xml"
-                            zipflike.write(os.path.join(root, xmlfile), arcname="korpus/" + newfilename)
-                            zipf.write(os.path.join(root, xmlfile), arcname="korpus/" + newfilename)
-                return filelike
-            else:
-                # används inte just nu
-                out = ['<trace>' + escape(self.trace) + '</trace>',
-                       '<stderr>' + escape(self.stderr) + '</stderr>',
-                       '<stdout>' + escape(self.stdout) + '</stdout>']
-                return "\n".join(out) + "\n"
-        else:
-            # används inte just nu
-            out = ['<trace>' + escape(self.trace) + '</trace>',
-                   '<stderr>' + escape(self.stderr) + '</stderr>',
-                   '<stdout>' + escape(self.stdout) + '</stdout>']
-            return "\n".join(out) + "\n"
+        tmp_path = "%s.%s.tmp" % (self.zipfpath, os.getpid())
+        with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zipf:
+            for root, _dirs, files in os.walk(self.export_dir):
+                for xmlfile in sorted(files):
+                    newfilename = xmlfile[:-4] + "_annotated.xml"
+                    zipf.write(os.path.join(root, xmlfile), arcname="korpus/" + newfilename)
+        os.rename(tmp_path, self.zipfpath)
+        return self.zipfpath
 
     def result(self):
         """
-        Return the result: either a built corpus with possible warning messages,
+        Generate the result: either a built corpus with possible warning messages,
         or the error messages for an unsuccessful build.
+        The corpus is streamed from disk in chunks, so that it is never held in
+        memory as a whole.
         """
         assert(finished(self.status))
-        out = []
 
         # Result when Parse Error
         if self.status == Status.ParseError:
             if self.warnings:
-                out.append('<warning>' + escape(self.warnings) + '</warning>')
-                out.append("<error>%s</error>" % ERROR_MSG["parsing_error"])
-                log.error(ERROR_MSG["parsing_error"])
-                return "\n".join(out)
+                yield '<warning>' + escape(self.warnings) + '</warning>\n'
+            yield "<error>%s</error>" % ERROR_MSG["parsing_error"]
+            log.error(ERROR_MSG["parsing_error"])
 
         # Result when Done
         elif self.status == Status.Done:
             download_link = "%s/download?hash=%s" % (Config.backend, self.build_hash)
-
-            if self.warnings:
-                out.append('<warning>' + escape(self.warnings) + '</warning>')
+            warnings = '<warning>' + escape(self.warnings) + '</warning>\n' if self.warnings else ""
 
             if hasattr(self, 'out_files'):
-                for out_file in self.out_files:
+                # The files of a batch build that failed have errors of their own, see file_result
+                for out_file in self.out_files if not self.batch else []:
                     if not os.path.exists(out_file):
                         self.change_status(Status.Error)
-                        out.append("<error>%s</error>" % ERROR_MSG["missing_file"])
                         log.error(ERROR_MSG["missing_file"])
-                        return "\n".join(out)
+                        yield warnings + "<error>%s</error>" % ERROR_MSG["missing_file"]
+                        return
 
-                result = "<corpus link='%s'/>\n" % download_link
-                return result
+                yield "<corpus link='%s'/>\n" % download_link
 
             else:
                 # Check for empty input (e.g. "<text></text>")
-                try:
-                    wordfile = os.path.join(self.annotations_dir, self.filename + '.token.word')
-                    with open(wordfile, "r") as f:
-                        word_contents = f.read()
-                        if not word_contents:
-                            raise ValueError('empty token.word file')
-                except:
+                wordfile = os.path.join(self.annotations_dir, self.filename + '.token.word')
+                if not os.path.isfile(wordfile) or os.path.getsize(wordfile) == 0:
                     self.change_status(Status.Error)
-                    log.exception(ERROR_MSG["empty_input"])
-                    return "<error>%s</error>" % ERROR_MSG["empty_input"]
+                    log.error(ERROR_MSG["empty_input"])
+                    yield "<error>%s</error>" % ERROR_MSG["empty_input"]
+                    return
 
-                # Check if result file is not empty
                 try:
-                    with open(self.out_file, "r") as f:
-                        result_contents = f.read()
-                        if not result_contents.strip("<corpus>\n").rstrip("</corpus>\n\n"):
-                            raise ValueError('empty result file')
-                        else:
-                            result_contents = result_contents.replace("<corpus", "<corpus link='%s'" % download_link)
-                            out.append(result_contents)
-                            return "\n".join(out)
-                except:
+                    f = open(self.out_file, "rb")
+                except IOError:
                     self.change_status(Status.Error)
                     log.exception(ERROR_MSG["no_result"])
-                    return "<error>%s</error>" % ERROR_MSG["no_result"]
+                    yield "<error>%s</error>" % ERROR_MSG["no_result"]
+                    return
+
+                with f:
+                    chunk = f.read(RESULT_CHUNK_SIZE)
+                    # Check if result file is not empty. Larger files always have contents.
+                    if len(chunk) < RESULT_CHUNK_SIZE:
+                        contents = chunk.decode(UTF8)
+                        if not contents.strip("<corpus>\n").rstrip("</corpus>\n\n"):
+                            self.change_status(Status.Error)
+                            log.error(ERROR_MSG["no_result"])
+                            yield "<error>%s</error>" % ERROR_MSG["no_result"]
+                            return
+
+                    # The corpus element starts the file, so it is in the first chunk
+                    link = ("<corpus link='%s'" % download_link).encode(UTF8)
+                    yield warnings
+                    yield chunk.replace(b"<corpus", link, 1)
+                    for chunk in iter(lambda: f.read(RESULT_CHUNK_SIZE), b""):
+                        yield chunk
+
+        elif self.status == Status.Cancelled:
+            yield "<error>%s</error>" % ERROR_MSG[self.cancel_reason or "cancelled"]
 
         else:
             out = ['<trace>' + escape(self.trace) + '</trace>',
                    '<stderr>' + escape(self.stderr) + '</stderr>',
                    '<stdout>' + escape(self.stdout) + '</stdout>',
                    '<error>' + ERROR_MSG["no_result"] + '</error>']
-            return "\n".join(out) + "\n"
+            yield "\n".join(out) + "\n"
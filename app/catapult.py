@@ -0,0 +1,198 @@
+# Client for the catapults, the servers that run the annotation steps of the
+# builds. A catapult is pinged over its UNIX socket, in the way catalaunch
+# talks to it, so that no process is started for a ping. The catapult closes
+# the connection after every request, so every ping connects anew.
+#
+# There may be several catapults, listed in Config.catapult_sockets, and
+# every build is assigned the least loaded catapult that serves its language.
+# The load is the number of builds of this process that use a catapult.
+#
+# The catapults are pinged in the background, and the latencies of the latest
+# pings are kept for /ping and /metrics.
+
+from builtins import object
+from collections import deque
+from threading import Lock, Thread
+import logging
+import os
+import socket
+import time
+
+from metrics import metrics
+from utils import percentile, TOOL_DICT, UTF8
+try:
+    from config import Config
+except ImportError:
+    from config_default import Config
+
+log = logging.getLogger('pipeline.' + __name__)
+
+PERCENTILES = [50, 90, 99]
+
+# Upper bounds (in seconds) of the buckets of the ping latency histogram
+PING_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5]
+
+
+def request_message(args):
+    """
+    A request to the catapult: the working directory and the arguments,
+    separated by spaces, and ended by a lone backslash. Backslashes and
+    spaces within the arguments are escaped with a backslash.
+    """
+    parts = [os.getcwd()] + list(args)
+    return " ".join(p.replace("\\", "\\\\").replace(" ", "\\ ") for p in parts) + "\\"
+
+
+class Catapult(object):
+    """
+    A catapult socket. Pings the catapult, and keeps the latencies of the
+    latest pings. A catapult with tags only serves builds of the languages
+    and analysis tools (the values of TOOL_DICT) among its tags.
+    """
+
+    def __init__(self, socket_file, tags, timeout, window):
+        self.socket_file = socket_file
+        self.tags = set(tags)
+        # The "python" interpreter of the builds that use this catapult
+        self.interpreter = Config.catalaunch_binary + " " + socket_file
+        self.labels = (("socket", socket_file),)
+        self.timeout = timeout
+        self.lock = Lock()
+        # The latencies of the latest successful pings
+        self.latencies = deque(maxlen=window)
+        # (time, latency, error) of the latest ping, error is None if it succeeded
+        self.last = None
+        # The builds of this process that use the catapult now, and ever
+        self.active = 0
+        self.assigned = 0
+
+    def serves(self, lang):
+        """Check if the catapult may run builds in language lang."""
+        return not self.tags or lang in self.tags or TOOL_DICT.get(lang) in self.tags
+
+    def request(self, args):
+        """Send a request to the catapult. Return its reply."""
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.settimeout(self.timeout)
+            s.connect(self.socket_file)
+            s.sendall(request_message(args).encode(UTF8))
+            chunks = []
+            for chunk in iter(lambda: s.recv(4096), b""):
+                chunks.append(chunk)
+            return b"".join(chunks).decode(UTF8)
+        finally:
+            s.close()
+
+    def ping(self):
+        """Ping the catapult. Return (latency, error), where error is None if it answered PONG."""
+        t0 = time.time()
+        try:
+            reply = self.request(["PING"])
+            error = None if reply == "PONG" else "Unexpected reply: %r" % reply
+        except (socket.error, UnicodeDecodeError) as e:
+            error = "%s" % e
+        latency = time.time() - t0
+        with self.lock:
+            self.last = (t0, latency, error)
+            if error is None:
+                self.latencies.append(latency)
+        if error is None:
+            metrics.observe("catapult_ping_seconds", self.labels, latency)
+        metrics.inc("catapult_pings_total", self.labels + (("result", "ok" if error is None else "error"),))
+        return latency, error
+
+    def latency_percentiles(self):
+        """The percentiles of the latencies of the latest pings, as a list of (p, seconds)."""
+        with self.lock:
+            values = sorted(self.latencies)
+        if not values:
+            return []
+        return [(p, percentile(values, p)) for p in PERCENTILES]
+
+    def is_up(self):
+        """Check if the catapult answered the latest ping."""
+        with self.lock:
+            return self.last is not None and self.last[2] is None
+
+    def is_down(self):
+        """Check if the catapult failed to answer the latest ping."""
+        with self.lock:
+            return self.last is not None and self.last[2] is not None
+
+
+class CatapultPool(object):
+    """
+    The catapults that the builds are spread over. Every entry of sockets
+    is a socket file, or a (socket file, tags) pair.
+    """
+
+    def __init__(self, sockets, timeout, window):
+        self.catapults = []
+        for entry in sockets:
+            socket_file, tags = (entry, []) if isinstance(entry, str) else entry
+            self.catapults.append(Catapult(socket_file, tags, timeout, window))
+        self.lock = Lock()
+        self.prober = None
+
+    def __iter__(self):
+        return iter(self.catapults)
+
+    def interpreters(self):
+        """The "python" interpreters of the catapults."""
+        return [c.interpreter for c in self.catapults]
+
+    def acquire(self, lang):
+        """
+        Assign a build in language lang the least loaded catapult that serves
+        the language. Catapults that did not answer their latest ping are only
+        chosen if no other catapult serves the language. Builds in a language
+        that no catapult serves may use any catapult.
+        """
+        with self.lock:
+            candidates = [c for c in self.catapults if c.serves(lang)]
+            if not candidates:
+                log.warning("No catapult serves language %s, choosing among all of them", lang)
+                candidates = self.catapults
+            candidates = [c for c in candidates if not c.is_down()] or candidates
+            catapult = min(candidates, key=lambda c: (c.active, c.assigned))
+            catapult.active += 1
+            catapult.assigned += 1
+        metrics.inc("catapult_builds_total", catapult.labels)
+        return catapult
+
+    def release(self, catapult, seconds):
+        """Tell that a build has stopped using catapult after seconds."""
+        with self.lock:
+            catapult.active -= 1
+        metrics.inc("catapult_build_seconds_total", catapult.labels, seconds)
+
+    def start_probes(self, interval):
+        """Ping the catapults every interval seconds in a background thread."""
+        if self.prober is not None or interval is None:
+            return
+
+        def probe():
+            was_up = {}
+            while True:
+                for catapult in self.catapults:
+                    _latency, error = catapult.ping()
+                    previous = was_up.get(catapult.socket_file)
+                    if error is not None and previous is not False:
+                        log.error("The catapult at %s does not answer: %s", catapult.socket_file, error)
+                    elif error is None and previous is False:
+                        log.info("The catapult at %s answers again", catapult.socket_file)
+                    was_up[catapult.socket_file] = error is None
+                time.sleep(interval)
+
+        self.prober = Thread(target=probe, name="catapult-prober")
+        self.prober.daemon = True
+        self.prober.start()
+
+
+catapults = CatapultPool(Config.catapult_sockets or [Config.socket_file],
+                         Config.catapult_ping_timeout, Config.catapult_latency_window)
+metrics.counter("catapult_pings_total", "Pings of the catapults from this process, by socket and result.")
+metrics.histogram("catapult_ping_seconds", "Time until a catapult answered a ping, by socket.", PING_BUCKETS)
+metrics.counter("catapult_builds_total", "Builds of this process assigned to each catapult.")
+metrics.counter("catapult_build_seconds_total", "Seconds that builds of this process have used each catapult.")
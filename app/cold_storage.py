@@ -0,0 +1,233 @@
+# Cold storage of idle builds. The input, annotation and result directories
+# of a finished build that has not been accessed for Config.cold_after
+# seconds are packed into one compressed archive in the build directory, and
+# removed. They are unpacked again, in place, before the build is read, so
+# that the paths of a Build stay the same. The small files of a build (the
+# makefile, the settings, the manifest and the logs) are never packed.
+#
+# A build is packed and unpacked with an exclusive lock on a file in its
+# directory, so that any worker process can unpack a build while another one
+# packs it. The files of a build are read with a shared lock on the same file,
+# so that a build is never packed while it is read. Only one worker process
+# looks for idle builds.
+
+from builtins import object
+from threading import Thread
+import fcntl
+import logging
+import os
+import shutil
+import tarfile
+import time
+
+from access_journal import access_journal
+from enums import Status, finished
+from metrics import metrics
+from trash import trash
+try:
+    from config import Config
+except ImportError:
+    from config_default import Config
+
+log = logging.getLogger('pipeline.' + __name__)
+
+ARCHIVE = "cold.tar.gz"
+
+# The directories of a build that are packed
+PACKED_DIRS = ["original", "annotations", "export.original"]
+
+# Upper bounds (in seconds) of the buckets of the unpacking time histogram
+THAW_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+
+class BuildLock(object):
+    """An exclusive lock on the cold storage of a build directory."""
+
+    def __init__(self, directory, blocking=True):
+        self.path = os.path.join(directory, "cold.lock")
+        self.blocking = blocking
+        self.f = None
+
+    def __enter__(self):
+        self.f = open(self.path, "w")
+        try:
+            fcntl.flock(self.f, fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self.f.close()
+            return False
+        return True
+
+    def __exit__(self, *exc):
+        self.f.close()
+
+
+class ReadLock(object):
+    """
+    A shared lock on the cold storage of a build directory, held while the
+    files of the build are read. The build is unpacked first, if it is packed.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.f = None
+
+    def acquire(self):
+        while True:
+            thaw(self.directory)
+            try:
+                f = open(os.path.join(self.directory, "cold.lock"), "a")
+            except IOError:
+                # The build has been removed
+                return
+            fcntl.flock(f, fcntl.LOCK_SH)
+            if not is_cold(self.directory):
+                self.f = f
+                return
+            # Packed again before the lock was taken
+            f.close()
+
+    def release(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def is_cold(directory):
+    return os.path.exists(os.path.join(directory, ARCHIVE))
+
+
+def freeze(directory):
+    """
+    Pack the directories of a build into the archive. Return the number of
+    bytes of the archive, or None if the build is being read or packed already.
+    """
+    with BuildLock(directory, blocking=False) as locked:
+        if not locked or is_cold(directory):
+            return None
+        archive = os.path.join(directory, ARCHIVE)
+        tmp_path = "%s.%s.tmp" % (archive, os.getpid())
+        with tarfile.open(tmp_path, "w:gz", compresslevel=6) as tar:
+            for d in PACKED_DIRS:
+                if os.path.isdir(os.path.join(directory, d)):
+                    tar.add(os.path.join(directory, d), arcname=d)
+        os.rename(tmp_path, archive)
+        trashed = [trash.move(os.path.join(directory, d)) for d in PACKED_DIRS]
+        trashed = [path for path in trashed if path is not None]
+        if trashed:
+            trash.delete(trashed)
+        return os.path.getsize(archive)
+
+
+def thaw(directory):
+    """Unpack the directories of a build, if it is packed. Return True if it was packed."""
+    if not is_cold(directory):
+        metrics.inc("storage_tier_hits_total", (("tier", "hot"),))
+        return False
+    t0 = time.time()
+    with BuildLock(directory):
+        archive = os.path.join(directory, ARCHIVE)
+        if not os.path.exists(archive):
+            # Unpacked by someone else while waiting for the lock
+            metrics.inc("storage_tier_hits_total", (("tier", "hot"),))
+            return False
+        tmp_dir = os.path.join(directory, "thaw.%s.tmp" % os.getpid())
+        with tarfile.open(archive, "r:gz") as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(tmp_dir, filter="data")
+            else:
+                tar.extractall(tmp_dir)
+        for d in os.listdir(tmp_dir):
+            # Left by an unpacking that was interrupted
+            if not os.path.exists(os.path.join(directory, d)):
+                os.rename(os.path.join(tmp_dir, d), os.path.join(directory, d))
+        shutil.rmtree(tmp_dir)
+        os.remove(archive)
+    seconds = time.time() - t0
+    log.info("Unpacked %s in %.2f seconds", os.path.basename(directory), seconds)
+    metrics.inc("storage_tier_hits_total", (("tier", "cold"),))
+    metrics.observe("cold_thaw_seconds", (), seconds)
+    return True
+
+
+class ColdStorage(object):
+    """Packs the builds that have been idle for longer than idle seconds."""
+
+    def __init__(self, lock_file, idle):
+        self.lock_file = lock_file
+        self.idle = idle
+        self.locked = None
+        self.thread = None
+
+    def _take_lock(self):
+        """Take the lock for looking for idle builds, unless another process holds it."""
+        if self.locked is None:
+            f = open(self.lock_file, "w")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                f.close()
+                return False
+            self.locked = f
+        return True
+
+    def freeze_idle(self, builds):
+        """Pack the idle builds. Return their hashes."""
+        if not self._take_lock():
+            return []
+        # Read the access times that the other processes have written
+        access_journal.flush()
+        frozen = []
+        deadline = time.time() - self.idle
+        for build_hash, build in builds.items():
+            # Cancelled builds may be started again, and builds without a
+            # manifest need their files to be restored
+            if (not finished(build.status) or build.status in [Status.Deleted, Status.Cancelled] or
+                    build.in_use() or build.accessed_time > deadline or
+                    not os.path.exists(build.manifest_file)):
+                continue
+            try:
+                size = freeze(build.directory)
+            except:
+                log.exception("Could not pack %s", build_hash)
+                continue
+            if size is not None:
+                log.info("Packed %s into %s bytes", build_hash, size)
+                metrics.inc("builds_packed_total")
+                frozen.append(build_hash)
+        return frozen
+
+    def start(self, builds, interval):
+        """Look for idle builds every interval seconds in a background thread."""
+        if self.thread is not None or self.idle is None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.freeze_idle(builds)
+                except:
+                    log.exception("Looking for idle builds failed")
+
+        self.thread = Thread(target=run, name="cold-storage")
+        self.thread.daemon = True
+        self.thread.start()
+
+
+cold_after = Config.cold_after
+if Config.use_x_sendfile and cold_after is not None:
+    # The web server reads an X-Sendfile download after the read lock of the
+    # build is released, so the build could be packed while it is being sent
+    log.warning("use_x_sendfile is set, builds are not packed (cold_after is ignored)")
+    cold_after = None
+cold_storage = ColdStorage(os.path.join(Config.registry_dir, "cold.lock"), cold_after)
+metrics.counter("storage_tier_hits_total", "Builds read from the hot tier, or unpacked from the cold tier first.")
+metrics.counter("builds_packed_total", "Idle builds packed into the cold tier.")
+metrics.histogram("cold_thaw_seconds", "Time to unpack a build from the cold tier.", THAW_BUCKETS)
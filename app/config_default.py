@@ -36,6 +36,11 @@ class Config(object):
     sparv_models = os.path.join(pipeline_dir, 'models')
     sparv_makefiles = os.path.join(pipeline_dir, 'makefiles')
 
+    # Let the web server in front of the backend send downloads (X-Sendfile).
+    # Without it, downloads use the sendfile support of the WSGI server.
+    # Builds are never packed (cold_after) when this is set.
+    use_x_sendfile = False
+
     # Secret key for dangerous queries
     secret_key = ""
 
@@ -46,21 +51,119 @@ class Config(object):
     # The number of processes (sent as a -j flag to make)
     processes = 2
 
+    # The number of builds that may run at the same time. Each running build
+    # uses up to 'processes' cores, so build_slots * processes should not
+    # exceed the number of cores.
+    build_slots = 2
+    # The number of builds that may wait for a free build slot. When the queue
+    # is full, new builds are refused with 503 Service Unavailable.
+    build_queue_size = 20
+    # Expected duration of a build in seconds, used for estimating waiting
+    # times until the first builds have finished
+    build_duration_estimate = 60
+
+    # Log the time of every annotation step of a build, for the /timings
+    # profile. Each step is then run through a small shell script.
+    step_timing = True
+
+    # Finished builds are evicted, the least recently accessed first, when the
+    # builds use more than builds_disk_budget bytes, or when the file system of
+    # builds_dir has less than builds_min_free_bytes free. None for no limit.
+    builds_disk_budget = None
+    builds_min_free_bytes = 2 * 1024 ** 3
+    # New builds are refused with 503 Service Unavailable while the file system
+    # has less than this many bytes free. None to never refuse them.
+    builds_critical_free_bytes = 512 * 1024 ** 2
+    # How often (in seconds) the disk budget is checked
+    eviction_interval = 60
+
+    # Finished builds that have not been accessed for this many seconds are
+    # packed into a compressed archive in their directory, and unpacked when
+    # they are asked for again. None to never pack them. Ignored when
+    # use_x_sendfile is set.
+    cold_after = 24 * 60 * 60
+    # How often (in seconds) idle builds are looked for
+    cold_check_interval = 10 * 60
+
+    # How often (in seconds) /metrics recounts the disk usage of builds_dir
+    metrics_disk_usage_interval = 300
+
+    # Builds running longer than this many seconds are stopped. None for no limit.
+    build_timeout = 6 * 60 * 60
+    # Text builds are stopped when nobody has waited for them during this many
+    # seconds. None to let them run anyway.
+    abandoned_build_grace = 60
+
+    # The largest number of texts in a request to /batch
+    batch_max_texts = 10000
+
+    # The number of make dry run results to keep in memory
+    dryrun_cache_size = 1000
+    # The number of generated makefiles to keep in memory, by settings
+    makefile_cache_size = 256
+
+    # Where annotation files are cached for reuse between builds of the same
+    # texts. Set this to None to disable the annotation cache.
+    annotation_cache_dir = os.path.join(builds_dir, 'annotation_cache')
+
+    # Where the original texts are stored once by their contents, and hard
+    # linked into the builds that use them. Must be on the same file system as
+    # builds_dir. Set this to None to write the texts into every build.
+    blob_store_dir = os.path.join(builds_dir, 'blobs')
+
     # Extension for file upload hash
     fileupload_ext = "-f"
 
+    # Where uploaded files are spooled until the build hash is known.
+    # Must be on the same file system as builds_dir.
+    incoming_dir = os.path.join(builds_dir, 'incoming')
+
+    # Where removed builds are moved before they are deleted in the background.
+    # Must be on the same file system as builds_dir.
+    trash_dir = os.path.join(builds_dir, 'trash')
+
+    # Where the registry of builds is kept. It is shared by the gunicorn workers.
+    registry_dir = os.path.join(builds_dir, 'registry')
+    # How often (in seconds) a worker checks the progress of builds run by other workers
+    registry_poll_interval = 1
+    # How often (in seconds) a worker writes the access times of builds to the
+    # access journal in registry_dir, and reads those of the other workers
+    access_journal_interval = 10
+
     # Socket file
     socket_file = os.path.join(builds_dir, 'pipeline.sock')
 
     # The catalaunch binary
     catalaunch_binary = os.path.join(builds_dir, 'catalaunch')
 
-    # The "python" interpreter, replaced with catalaunch
-    python_interpreter = catalaunch_binary + " " + socket_file
+    # The catapult sockets that the builds are spread over, None for only socket_file.
+    # An entry is a socket file, or a (socket file, tags) pair, where the tags are
+    # languages or analysis tools of TOOL_DICT (e.g. ["fl", "tt"]) whose builds
+    # the catapult serves. Builds get the least loaded catapult that serves them,
+    # and run their annotation steps with catalaunch and that socket.
+    catapult_sockets = None
+
+    # How often (in seconds) every worker pings the catapults. None to only ping on /ping.
+    catapult_probe_interval = 30
+    # Seconds to wait for the catapult to answer a ping
+    catapult_ping_timeout = 5
+    # The number of latest pings that the latency percentiles are computed from
+    catapult_latency_window = 100
 
     ############################################################################
     # Gunicorn config
     gunicorn_errorlog = os.path.join(log_dir, "gunicorn.log")  # gunicorn log file. Remove for logging to console
     gunicorn_timeout = 200  # workers silent for more than this many seconds are killed and restarted
-    gunicorn_workers = 1    # number of worker process for handling requests
+    gunicorn_workers = 1    # number of worker process for handling requests (they share builds through the registry)
     ############################################################################
+
+
+def complete(config):
+    """
+    Give config the options of Config that it lacks, e.g. when config.py is a
+    copy of an older config_default.py. Return config.
+    """
+    for name, value in vars(Config).items():
+        if not name.startswith("__") and not hasattr(config, name):
+            setattr(config, name, value)
+    return config
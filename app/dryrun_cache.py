@@ -0,0 +1,59 @@
+# Cache for the results of make dry runs. The number of steps in a build only
+# depends on the makefile, the make target and the number of input files, so
+# the dry run only needs to be done once for every such combination.
+
+from builtins import object
+from collections import OrderedDict
+from threading import Lock
+import logging
+
+from utils import make_hash
+try:
+    from config import Config
+except ImportError:
+    from config_default import Config
+
+log = logging.getLogger('pipeline.' + __name__)
+
+
+class DryRunCache(object):
+    """
+    A size bounded LRU cache mapping (makefile, target, number of files) to
+    the number of steps of a build.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(makefile_contents, target, n_files):
+        return (make_hash(makefile_contents), target, n_files)
+
+    def get(self, key):
+        """Return the number of steps for key, or None on a cache miss."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, steps):
+        with self.lock:
+            self.entries[key] = steps
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+
+dryrun_cache = DryRunCache(Config.dryrun_cache_size)
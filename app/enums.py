@@ -12,7 +12,7 @@ def enum(*sequential):
     return type('Enum', (), enums)
 
 # The possible statuses of a pipeline
-Status = enum('Init', 'Parsing', 'Running', 'Done', 'Error', 'ParseError', 'Deleted')
+Status = enum('Init', 'Parsing', 'Running', 'Done', 'Error', 'ParseError', 'Deleted', 'Queued', 'Cancelled')
 
 # The possible message types from the pipeline
 Message = enum('StatusChange', 'Increment')
@@ -20,4 +20,5 @@ Message = enum('StatusChange', 'Increment')
 
 def finished(status):
     """The statuses that signify a finished build"""
-    return status == Status.Done or status == Status.Error or status == Status.ParseError
+    return (status == Status.Done or status == Status.Error or status == Status.ParseError or
+            status == Status.Cancelled)
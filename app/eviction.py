@@ -0,0 +1,194 @@
+# Keeps the builds directory within its disk budget. A background thread
+# keeps the size of every build directory, and when the builds use more than
+# Config.builds_disk_budget bytes, or the file system has less than
+# Config.builds_min_free_bytes free, it removes finished builds, the least
+# recently accessed first. New builds are refused while the file system has
+# less than Config.builds_critical_free_bytes free.
+#
+# Only one worker process evicts builds, the one that holds the eviction lock.
+
+from builtins import object
+from threading import Lock, Thread
+import fcntl
+import logging
+import os
+import time
+
+from blob_store import blob_store
+from cold_storage import BuildLock
+from enums import Status, finished
+from metrics import metrics
+from scheduler import QueueFull
+from trash import trash
+try:
+    from config import Config
+except ImportError:
+    from config_default import Config
+
+log = logging.getLogger('pipeline.' + __name__)
+
+# Seconds that an original text that no build uses is kept when evicting
+BLOB_GRACE = 10 * 60
+
+
+class DiskFull(QueueFull):
+    """Raised when a build cannot be started because the disk is almost full."""
+
+    reason = "disk_full"
+
+
+def directory_size(directory):
+    """
+    The number of bytes used by the files under directory. A file with
+    several hard links counts with its share of the links, so that files
+    shared with the annotation cache or other builds are not counted twice.
+    """
+    used = 0
+    for root, _dirs, files in os.walk(directory):
+        for f in files:
+            try:
+                st = os.lstat(os.path.join(root, f))
+            except OSError:
+                continue
+            used += st.st_size // max(st.st_nlink, 1)
+    return used
+
+
+class Evictor(object):
+    """
+    Evict finished builds when the builds directory is over its budget.
+
+    The size of a build directory is counted when the build is first seen,
+    and recounted as long as the build may still grow. The sizes of
+    finished builds are kept until the build directory changes.
+    """
+
+    def __init__(self, builds_dir, lock_file, budget, min_free, critical_free):
+        self.builds_dir = builds_dir
+        self.lock_file = lock_file
+        self.budget = budget
+        self.min_free = min_free
+        self.critical_free = critical_free
+        # Build hash to (bytes, whether the build had finished when counted,
+        # modification time of the build directory)
+        self.sizes = {}
+        self.used = 0
+        self.evicted = 0
+        self.lock = Lock()
+        self.locked = None
+        self.thread = None
+
+    def free_bytes(self):
+        fs = os.statvfs(self.builds_dir)
+        return fs.f_bavail * fs.f_frsize
+
+    def check_space(self, retry_after):
+        """Raise DiskFull if the file system of the builds is critically full."""
+        if self.critical_free is not None and self.free_bytes() < self.critical_free:
+            log.error("Less than %s bytes free in %s, refusing new builds", self.critical_free, self.builds_dir)
+            raise DiskFull(retry_after)
+
+    def _take_lock(self):
+        """Take the eviction lock, unless another process holds it. Return True if this process holds it."""
+        if self.locked is None:
+            f = open(self.lock_file, "w")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                f.close()
+                return False
+            self.locked = f
+        return True
+
+    def _measure(self, items):
+        """Update the sizes of the builds in items, a list of (hash, BuildRow)."""
+        sizes = {}
+        for build_hash, build in items:
+            directory = os.path.join(self.builds_dir, build_hash)
+            try:
+                mtime = os.path.getmtime(directory)
+            except OSError:
+                continue
+            known = self.sizes.get(build_hash)
+            # A finished build changes when it is packed or unpacked, see cold_storage.py
+            if known is not None and known[1] and known[2] == mtime:
+                sizes[build_hash] = known
+            else:
+                sizes[build_hash] = (directory_size(directory), finished(build.status), mtime)
+        with self.lock:
+            self.sizes = sizes
+            self.used = sum(size[0] for size in sizes.values())
+
+    def evict(self, builds):
+        """Evict builds until the builds directory is within its budget. Return the evicted hashes."""
+        if not self._take_lock():
+            return []
+        items = builds.items()
+        self._measure(items)
+        excess = 0
+        if self.budget is not None:
+            excess = self.used - self.budget
+        if self.min_free is not None:
+            excess = max(excess, self.min_free - self.free_bytes())
+        if excess <= 0:
+            return []
+        if blob_store is not None:
+            # The original texts of builds that have been removed
+            blob_store.prune(BLOB_GRACE)
+
+        # Builds that a client of any process is waiting for are left alone
+        candidates = [(h, b) for h, b in items
+                      if finished(b.status) and b.status != Status.Deleted and not b.in_use() and
+                      os.path.isdir(b.directory)]
+        candidates.sort(key=lambda item: item[1].accessed_time)
+        evicted = []
+        trashed = []
+        for build_hash, build in candidates:
+            if excess <= 0:
+                break
+            size = self.sizes.get(build_hash, (0,))[0]
+            with BuildLock(build.directory, blocking=False) as locked:
+                if not locked:
+                    # Being read, or packed, see cold_storage.py
+                    continue
+                log.info("Evicting %s (%s bytes, accessed %.0f seconds ago)",
+                         build_hash, size, time.time() - build.accessed_time)
+                trashed.append(builds.remove(build_hash))
+            with self.lock:
+                self.sizes.pop(build_hash, None)
+                self.used -= size
+                self.evicted += 1
+            metrics.inc("builds_evicted_total")
+            metrics.inc("builds_evicted_bytes_total", (), size)
+            excess -= size
+            evicted.append(build_hash)
+        trashed = [path for path in trashed if path is not None]
+        if trashed:
+            trash.delete(trashed)
+        if excess > 0:
+            log.warning("The builds directory is %s bytes over its budget, but no more builds can be evicted",
+                        excess)
+        return evicted
+
+    def start(self, builds, interval):
+        """Check the disk budget every interval seconds in a background thread."""
+        if self.thread is not None or (self.budget is None and self.min_free is None):
+            return
+
+        def run():
+            while True:
+                try:
+                    self.evict(builds)
+                except:
+                    log.exception("Eviction failed")
+                time.sleep(interval)
+
+        self.thread = Thread(target=run, name="evictor")
+        self.thread.daemon = True
+        self.thread.start()
+
+
+evictor = Evictor(Config.builds_dir, os.path.join(Config.registry_dir, "eviction.lock"),
+                  Config.builds_disk_budget, Config.builds_min_free_bytes, Config.builds_critical_free_bytes)
+metrics.counter("builds_evicted_total", "Builds evicted to keep the builds directory within its disk budget.")
+metrics.counter("builds_evicted_bytes_total", "Bytes freed by evicting builds.")
@@ -1,18 +1,22 @@
 import smtplib
 
 from builtins import str
-from queue import Queue
-from threading import Thread
+from xml.etree import ElementTree
 from xml.sax.saxutils import escape, unescape
 from werkzeug.utils import secure_filename
 from flask import Response, request, json
+import io
 import logging
+import time
 
 from build import Build
 from enums import Status, Message, finished
-from schema_utils import validate_json
-from schema_generator import make_schema
-from utils import pretty_epoch_time, ERROR_MSG, make_trace
+from eviction import evictor
+from scheduler import scheduler, QueueFull
+from schema_generator import prepared_schema
+from trash import trash
+from upload import UploadSpool
+from utils import pretty_epoch_time, ERROR_MSG, make_trace, UTF8
 try:
     from config import Config
 except ImportError:
@@ -24,46 +28,75 @@ log = logging.getLogger('pipeline.' + __name__)
 def build(builds, original_text, settings, incremental, fmt, files=None):
     """
     Start a build for this corpus. If it is already running,
-    join it. Messages from the build are received on a queue.
+    join it. Messages from the build are received by a listener.
+    Raises QueueFull if the build cannot be queued.
+    """
+    build = start_build(builds, original_text, settings, fmt, files)
+    if files:
+        return join_build(build, incremental, fileupload=True)
+    else:
+        return join_build(build, incremental)
+
+
+def start_build(builds, original_text, settings, fmt, files=None, batch=False):
+    """
+    Start a build for this corpus, unless the same build is registered
+    already. Return the build. Raises QueueFull if the build cannot be queued,
+    or DiskFull if the disk is too full for a new build.
     """
     if not files:
         build = Build(original_text, settings)
     else:
-        build = Build(original_text, settings, files=files)
+        build = Build(original_text, settings, files=files, batch=batch)
 
     # Start build or listen to existing build
-    if build.build_hash not in builds:
-        builds[build.build_hash] = build
-        build.make_files()
-        t = Thread(target=Build.run, args=[build, fmt])
-        t.start()
+    existing = builds.setdefault(build.build_hash, build)
+    if existing is build:
+        try:
+            evictor.check_space(Config.eviction_interval)
+            scheduler.submit(build, fmt, prepare=build.make_files)
+        except QueueFull:
+            del builds[build.build_hash]
+            if files:
+                files.discard()
+            raise
+        except:
+            # Unregister a build whose files could not be made, or it is
+            # joined and waited for forever, and do not reuse its files
+            log.exception("Could not start build %s", build.build_hash)
+            del builds[build.build_hash]
+            if files:
+                files.discard()
+            trashed = trash.move(build.directory)
+            if trashed is not None:
+                trash.delete([trashed])
+            raise
     # elif builds[build.build_hash].status == (Status.Error or Status.ParseError):
     #     log.info("Errorneous build found! Retrying...")
     #     t = Thread(target=Build.run, args=[build, fmt])
     #     t.start()
     else:
-        build = builds[build.build_hash]
+        if files:
+            # The existing build already has these files
+            files.discard()
+        build = existing
         log.info("Joining existing build (%s) which started at %s" %
                  (build.build_hash, pretty_epoch_time(build.status_change_time)))
-
-    if files:
-        return join_build(build, incremental, fileupload=True)
-    else:
-        return join_build(build, incremental)
+    return build
 
 
 def join_from_hash(builds, hashnumber, incremental):
     """Join a build with a given hash number if it exists."""
     build = builds.get(hashnumber, None)
     if build is not None:
+        with build.hot_files():
+            settings, original = build.get_settings(), build.get_original()
         if hashnumber.endswith(Config.fileupload_ext):
-            yield ("<settings>%s</settings>\n<original %s/>\n"
-                   % (build.get_settings(), escape(build.get_original())))
+            yield "<settings>%s</settings>\n<original %s/>\n" % (settings, escape(original))
             for node, _b in join_build(build, True, fileupload=True):
                 yield node
         else:
-            yield ("<settings>%s</settings>\n<original>%s</original>\n"
-                   % (build.get_settings(), escape(build.get_original())))
+            yield "<settings>%s</settings>\n<original>%s</original>\n" % (settings, escape(original))
             for node in join_build(build, incremental):
                 yield node
     else:
@@ -76,63 +109,209 @@ def join_build(build, incremental, fileupload=False):
     until it is completed. Then send the build's result or
     the link to the downloadable zip file.
     """
-    # Make a new queue which receives messages from the builder process
-    queue = Queue()
-    build.queues.append(queue)
+    # Listen for messages from the builder process. The listener is
+    # unregistered when the response generator is closed.
+    listener = build.hub.listen()
+    build.last_watched = time.time()
 
     def get_result():
+        if build.status == Status.Deleted:
+            # Removed while the client was waiting, see BuildRegistry.remove
+            yield "<error>%s</error>\n</result>\n" % ERROR_MSG["cancelled"]
+            return
         assert(finished(build.status))
         build.access()
         try:
-            return build.result() + '</result>\n'
+            with build.hot_files():
+                for chunk in build.result():
+                    yield chunk
+            yield '</result>\n'
         except Exception as error:
             log.error("Error while getting result: %s" % str(error))
-            return "<error>%s\n</error>\n</result>\n" % ERROR_MSG["no_result"]
-
-    # Send this build's hash
-    if fileupload:
-        yield "<build hash='%s' type='files'/>\n" % build.build_hash, build
-    else:
-        yield "<build hash='%s'/>\n" % build.build_hash
+            yield "<error>%s\n</error>\n</result>\n" % ERROR_MSG["no_result"]
 
-    # Result already exists
-    if finished(build.status):
-        log.info("Result already exists since %s" %
-                 pretty_epoch_time(build.status_change_time))
+    try:
+        # Send this build's hash
         if fileupload:
-            yield get_result(), build
+            yield "<build hash='%s' type='files'/>\n" % build.build_hash, build
         else:
-            yield get_result()
+            yield "<build hash='%s'/>\n" % build.build_hash
 
-    # Listen for completion
-    else:
-        if incremental and build.status == Status.Running:
-            log.info("Already running, sending increment message")
+        # Result already exists
+        if finished(build.status):
+            log.info("Result already exists since %s" %
+                     pretty_epoch_time(build.status_change_time))
+
+        # Listen for completion
+        else:
+            for msg in wait_for_build(build, listener, incremental):
+                if fileupload:
+                    yield msg, build
+                else:
+                    yield msg
+
+        listener.close()
+        for chunk in get_result():
             if fileupload:
-                yield build.increment_msg(), build
+                yield chunk, build
             else:
-                yield build.increment_msg()
+                yield chunk
+    finally:
+        listener.close()
+
 
-        while True:
-            msg_type, msg = queue.get()
+def wait_for_build(build, listener, incremental):
+    """
+    Wait until a build has finished. If incremental, yield the increment
+    messages of the build meanwhile.
+    """
+    if incremental and build.status in (Status.Queued, Status.Running):
+        log.info("Already queued or running, sending increment message")
+        yield build.increment_msg()
+
+    done = False
+    while not done:
+        for msg_type, msg in listener.get():
             if msg_type == Message.StatusChange:
                 log.info("Message %s" % Status.lookup[msg])
-            # Has status changed to finished?
-            if msg_type == Message.StatusChange:
-                if finished(msg):
-                    break
+                # Has status changed to finished, or has the build been removed?
+                if finished(msg) or msg == Status.Deleted:
+                    done = True
             # Increment message
             elif incremental and msg_type == Message.Increment:
-                if fileupload:
-                    yield msg, build
-                else:
-                    yield msg
+                yield msg
 
-        log.info("Getting result...")
-        if fileupload:
-            yield get_result(), build
-        else:
-            yield get_result()
+    log.info("Getting result...")
+
+
+def batch_procedure(builds, settings, mode, texts, incremental, fmt):
+    """
+    Build a batch of texts as the files of one build. Texts that cannot be
+    built are left out of the build and get an error of their own. The
+    build is started right away, so that QueueFull can be raised before the
+    response is sent. Returns a generator for the response, in the format
+    fmt ("xml" or "ndjson").
+    """
+    names = []
+    errors = {}
+    files = UploadSpool()
+    width = len(str(len(texts) - 1))
+    try:
+        for index, text in enumerate(texts):
+            error = batch_text_error(text, mode)
+            if error is not None:
+                errors[index] = error
+                names.append(None)
+                continue
+            if mode == "plain":
+                text = "<text>" + escape(text) + "</text>"
+            name = "text%0*d" % (width, index)
+            files.add(name, io.BytesIO(text.encode(UTF8)))
+            names.append(name)
+    except:
+        files.discard()
+        raise
+
+    if len(files):
+        log.info("Starting a new build with %d texts of a batch" % len(files))
+        batch_build = start_build(builds, "", settings, "xml", files=files, batch=True)
+    else:
+        files.discard()
+        batch_build = None
+    return batch_result(batch_build, names, errors, incremental, fmt)
+
+
+def batch_text_error(text, mode):
+    """The error message for a text of a batch that cannot be built, or None."""
+    if not isinstance(text, str):
+        return ERROR_MSG["not_text"]
+    if not text.strip():
+        return ERROR_MSG["empty_input"]
+    if mode != "plain":
+        try:
+            # The text may be a fragment with several elements
+            ElementTree.fromstring("<batch>%s</batch>" % text)
+        except ElementTree.ParseError:
+            return ERROR_MSG["parsing_error"]
+    return None
+
+
+def batch_result(batch_build, names, errors, incremental, fmt):
+    """Send the messages from a batch build, and the result of each text."""
+    if fmt == "ndjson":
+        for item in batch_items(batch_build, names, errors, incremental):
+            yield batch_item_json(item)
+    else:
+        yield "<result>\n"
+        for item in batch_items(batch_build, names, errors, incremental):
+            yield batch_item_xml(item)
+        yield "</result>\n"
+
+
+def batch_items(batch_build, names, errors, incremental):
+    """
+    The messages of a batch build, as tuples: ("build", build),
+    ("increment", message, build) and ("warning", warnings), followed by
+    ("result", index, contents) or ("error", index, message) for each text.
+    """
+    if batch_build is not None:
+        listener = batch_build.hub.listen()
+        batch_build.last_watched = time.time()
+        try:
+            yield ("build", batch_build)
+            if not finished(batch_build.status):
+                for msg in wait_for_build(batch_build, listener, incremental):
+                    yield ("increment", msg, batch_build)
+        finally:
+            listener.close()
+        batch_build.access()
+        warnings = getattr(batch_build, "warnings", None)
+        if warnings:
+            yield ("warning", warnings)
+
+    hot_files = batch_build.hot_files() if batch_build is not None else None
+    if hot_files is not None:
+        hot_files.acquire()
+    try:
+        for index, name in enumerate(names):
+            if name is None:
+                yield ("error", index, errors[index])
+                continue
+            contents, error = batch_build.file_result(name)
+            if error is not None:
+                yield ("error", index, error)
+            else:
+                yield ("result", index, contents)
+    finally:
+        if hot_files is not None:
+            hot_files.release()
+
+
+def batch_item_xml(item):
+    if item[0] == "build":
+        return "<build hash='%s' type='files'/>\n" % item[1].build_hash
+    elif item[0] == "increment":
+        return item[1]
+    elif item[0] == "warning":
+        return "<warning>%s</warning>\n" % escape(item[1])
+    elif item[0] == "result":
+        return ("<text index='%d'>" % item[1]).encode(UTF8) + item[2].rstrip(b"\n") + b"</text>\n"
+    return "<text index='%d'><error>%s</error></text>\n" % (item[1], item[2])
+
+
+def batch_item_json(item):
+    if item[0] == "build":
+        obj = {"build": item[1].build_hash}
+    elif item[0] == "increment":
+        b = item[2]
+        obj = {"increment": {"command": b.command, "step": b.step, "steps": b.steps}}
+    elif item[0] == "warning":
+        obj = {"warning": unescape(item[1])}
+    elif item[0] == "result":
+        obj = {"index": item[1], "result": item[2].decode(UTF8)}
+    else:
+        obj = {"index": item[1], "error": item[2]}
+    return json.dumps(obj) + "\n"
 
 
 def get_files(infiles):
@@ -248,20 +427,25 @@ def send_crash_mail(adress, hashnumber, warnings):
 
 
 def upload_procedure(builds, settings, files, email):
-    """The file upload procedure. Called by wrapper 'file_upload()'."""
-
+    """
+    The file upload procedure. Called by wrapper 'file_upload()'.
+    The build is started right away, so that QueueFull can be raised before
+    the response is sent. Returns a generator for the response.
+    """
     if not files:
-        log.exception(ERROR_MSG["no_files"])
-        yield '<result>\n<error>' + ERROR_MSG["no_files"] + '</error>\n</result>\n'
-        raise StopIteration
+        log.error(ERROR_MSG["no_files"])
+        return iter(['<result>\n<error>' + ERROR_MSG["no_files"] + '</error>\n</result>\n'])
 
-    yield "<result>\n"
     log.info("Starting a new build with file upload procedure")
-    for node, current_build in build(builds, "", settings, True, "xml", files=files):
-        yield node
+    nodes = build(builds, "", settings, True, "xml", files=files)
+    return upload_result(nodes, email)
 
-    # create downloadable zip file
-    current_build.zip_result()
+
+def upload_result(nodes, email):
+    """Send the messages from a file upload build and mail the result."""
+    yield "<result>\n"
+    for node, current_build in nodes:
+        yield node
 
     # something went wrong...
     if current_build.status == Status.Error or current_build.status == Status.ParseError:
@@ -281,7 +465,7 @@ def upload_procedure(builds, settings, files, email):
 
 def get_settings(lang, mode):
     """Get the makefile settings."""
-    schema_json = make_schema(lang, mode)
+    settings_validator = prepared_schema(lang, mode).validator
     error = None
 
     try:
@@ -290,7 +474,6 @@ def get_settings(lang, mode):
         log.exception("Error in json parsing the settings variable")
         error = escape(make_trace())
         settings = {}
-    settings_validator = validate_json(schema_json)
     for e in sorted(settings_validator.iter_errors(settings)):
         if error is None:
             error = ""
@@ -307,6 +490,30 @@ def get_settings(lang, mode):
         return settings, incremental
 
 
+def queue_full_response(error):
+    """The response for a build that could not be queued."""
+    log.error(ERROR_MSG[error.reason])
+    res = '<result>\n<error>%s</error>\n</result>\n' % ERROR_MSG[error.reason]
+    response = Response(res, status=503, mimetype='application/xml')
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
+def removal_message(removed, trashed):
+    """
+    The response of a cleanup that removed the builds with the hashes in
+    removed, and moved the directories in trashed to the trash. The
+    directories are deleted by a background job, which is reported.
+    """
+    trashed = [path for path in trashed if path is not None]
+    res = ["<removed hash='%s'/>" % h for h in removed]
+    if trashed:
+        res.append("<deletion-job id='%s' directories='%s'/>" % (trash.delete(trashed), len(trashed)))
+    if len(res) == 0:
+        return "<message>No hashes to be removed.</message>\n"
+    return "<message>\n%s\n</message>\n" % "\n".join(res)
+
+
 def check_secret_key(secret_key):
     if Config.secret_key and secret_key == Config.secret_key:
         log.info("Secret key was confirmed.")
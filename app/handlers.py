@@ -2,18 +2,29 @@
 
 from future import standard_library
 standard_library.install_aliases()
-from flask import Flask, Response, request, json, render_template, send_from_directory
+from flask import Flask, Response, g, request, json, render_template, send_from_directory
 from flask_cors import CORS
 from xml.sax.saxutils import escape
 import logging
 import time
 import os
 
-from make_makefile import makefile
-from schema_generator import make_schema
-from utils import pretty_epoch_time, get_build_directories, rmdir, ERROR_MSG, make_trace, UTF8
-from handler_utils import build, upload_procedure, get_settings, join_from_hash, check_secret_key
+from make_makefile import cached_makefile, makefile
+from schema_generator import prepared_schema
+from utils import pretty_epoch_time, get_build_directories, ERROR_MSG, make_trace
+from handler_utils import (build, batch_procedure, upload_procedure, get_settings, join_from_hash,
+                           check_secret_key, queue_full_response, removal_message)
 from enums import Status, finished
+from scheduler import scheduler, QueueFull
+from dryrun_cache import dryrun_cache
+from annotation_cache import annotation_cache
+from blob_store import blob_store
+from upload import UploadSpool, remove_stale_uploads
+from timings import aggregate as aggregate_timings, HISTOGRAM_BOUNDS as TIMING_BOUNDS
+from metrics import metrics, request_numbers, DiskUsage
+from catapult import catapults
+from eviction import evictor
+from trash import trash
 try:
     from config import Config
 except ImportError:
@@ -21,17 +32,30 @@ except ImportError:
 
 app = Flask(__name__)
 CORS(app)  # enables CORS support on all routes
+# Let the web server send result files if it supports X-Sendfile
+app.config["USE_X_SENDFILE"] = Config.use_x_sendfile
 log = logging.getLogger('pipeline.' + __name__)
 
+builds_dir_usage = DiskUsage(Config.builds_dir, Config.metrics_disk_usage_interval)
+
 
 @app.before_request
 def my_method():
-    app.config["N_REQUESTS"] += 1
+    g.request_start = time.time()
     try:
         path = request.url_rule.rule
     except:
         path = "/"
-    log.info("Handling %s (request %s)" % (path, int(app.config["N_REQUESTS"])))
+    log.info("Handling %s (request %s)" % (path, next(request_numbers)))
+
+
+@app.after_request
+def count_request(response):
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.inc("requests_total", (("route", route), ("method", request.method), ("code", response.status_code)))
+    if "request_start" in g:
+        metrics.observe("request_duration_seconds", (("route", route),), time.time() - g.request_start)
+    return response
 
 
 @app.route('/hello')
@@ -123,50 +147,142 @@ def status():
                          pretty_epoch_time(b.status_change_time),
                          pretty_epoch_time(b.accessed_time),
                          round(time.time() - b.accessed_time, 1)))
-
+        res += ("<scheduler slots='%s' running='%s' queued='%s' average-duration='%s'/>\n" %
+                (scheduler.slots, scheduler.running, scheduler.queue_depth(),
+                 round(scheduler.avg_duration, 1)))
+        res += ("<dryrun-cache entries='%s' hits='%s' misses='%s' hit-rate='%s'/>\n" %
+                (len(dryrun_cache.entries), dryrun_cache.hits, dryrun_cache.misses,
+                 round(dryrun_cache.hit_rate(), 3)))
+        makefile_cache = cached_makefile.cache_info()
+        res += ("<makefile-cache entries='%s' hits='%s' misses='%s'/>\n" %
+                (makefile_cache.currsize, makefile_cache.hits, makefile_cache.misses))
+        for c in catapults:
+            res += ("<catapult socket='%s' tags='%s' up='%s' active-builds='%s' builds='%s'/>\n" %
+                    (escape(c.socket_file), escape(" ".join(sorted(c.tags))), c.is_up(), c.active, c.assigned))
+        if blob_store is not None:
+            res += "<blob-store hits='%s' misses='%s'/>\n" % (blob_store.hits, blob_store.misses)
+        if annotation_cache is not None:
+            res += ("<annotation-cache hits='%s' misses='%s'/>\n" %
+                    (annotation_cache.hits, annotation_cache.misses))
+        res += ("<disk free='%s' builds-used='%s' budget='%s' evicted='%s'/>\n" %
+                (evictor.free_bytes(), evictor.used, evictor.budget, evictor.evicted))
         res += "</status>\n"
     else:
         res = "<error>Failed to show status: secret key could not be confirmed.</error>\n"
     return Response(res, mimetype='application/xml', content_type='application/xml; charset=utf-8')
 
 
+@app.route('/metrics')
+def get_metrics():
+    """
+    The /metrics handler.
+    Return the metrics of this worker process in the Prometheus text format.
+    """
+    builds = app.config["BUILDS"]
+    status_counts = builds.status_counts()
+    fs = os.statvfs(Config.builds_dir)
+    gauges = [
+        ("builds", "Registered builds, by status.",
+         [((("status", Status.lookup[s]),), status_counts.get(s, 0)) for s in sorted(Status.lookup)]),
+        ("make_processes_running", "Builds running make in this process.", [((), scheduler.running)]),
+        ("build_queue_depth", "Builds waiting for a build slot in this process.", [((), scheduler.queue_depth())]),
+        ("listeners", "Clients waiting for builds in this process.", [((), builds.listener_count())]),
+        ("dryrun_cache_hit_ratio", "Share of dry runs answered from the cache.", [((), dryrun_cache.hit_rate())]),
+        ("builds_dir_used_bytes", "Bytes used by the files in the builds directory.", [((), builds_dir_usage.get())]),
+        ("builds_fs_free_bytes", "Free bytes on the file system of the builds directory.",
+         [((), fs.f_bavail * fs.f_frsize)]),
+        ("builds_fs_size_bytes", "Size of the file system of the builds directory.", [((), fs.f_blocks * fs.f_frsize)]),
+        ("catapult_up", "Whether each catapult answered its latest ping.",
+         [(c.labels, int(c.is_up())) for c in catapults]),
+        ("catapult_ping_latency_seconds", "Latency percentiles of the latest pings of each catapult.",
+         [(c.labels + (("quantile", p / 100.0),), v) for c in catapults for p, v in c.latency_percentiles()]),
+        ("catapult_active_builds", "Builds of this process that use each catapult.",
+         [(c.labels, c.active) for c in catapults]),
+    ]
+    if annotation_cache is not None:
+        lookups = annotation_cache.hits + annotation_cache.misses
+        gauges.append(("annotation_cache_hit_ratio", "Share of input files with cached annotations.",
+                       [((), float(annotation_cache.hits) / lookups if lookups else 0.0)]))
+    return Response(metrics.render(gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/timings')
+def timings():
+    """
+    The /timings handler.
+    Return the time spent in each annotation step, per language and annotator,
+    over the kept builds. Requires secret_key parameter in query.
+    """
+    secret_key = request.values.get('secret_key', '')
+    if check_secret_key(secret_key):
+        summary = aggregate_timings(Config.builds_dir)
+        res = "<timings>\n"
+        for lang in sorted(summary):
+            res += "<language name='%s'>\n" % escape(lang)
+            for name, s in sorted(summary[lang].items()):
+                percentiles = " ".join("p%s='%s'" % (p, round(v, 3)) for p, v in s["percentiles"])
+                res += ("<annotator name='%s' count='%s' total='%s' max='%s' %s>\n" %
+                        (escape(name), s["count"], round(s["total"], 3), round(s["max"], 3), percentiles))
+                for bound, count in zip(TIMING_BOUNDS + ["inf"], s["histogram"]):
+                    res += "<bin upto='%s' count='%s'/>\n" % (bound, count)
+                res += "</annotator>\n"
+            res += "</language>\n"
+        res += "</timings>\n"
+    else:
+        res = "<error>Failed to show timings: secret key could not be confirmed.</error>\n"
+    return Response(res, mimetype='application/xml', content_type='application/xml; charset=utf-8')
+
+
 @app.route('/ping')
 def ping():
     """
     The /ping handler.
-    Ping this script, respond with the status of the catapult.
+    Ping this script, respond with the status of the catapults and the
+    latencies of the latest pings.
     """
-    ping_error_msg = "<error>\n<catapult time='%s'>\n<stdout>%s</stdout>\n<stderr>%s</stderr>\n</catapult>\n</error>"
+    catapult_msg = "<catapult%s time='%s'%s>PONG</catapult>\n"
+    catapult_error_msg = "<catapult%s time='%s'>\n<stdout>%s</stdout>\n<stderr>%s</stderr>\n</catapult>\n"
+    # The sockets are only told apart when there are several
+    several = len(catapults.catapults) > 1
+    xml = ""
+    failed = False
     try:
-        t0 = time.time()
-        from subprocess import Popen, PIPE
-        cmd = [Config.catalaunch_binary, Config.socket_file, "PING"]
-        stdout, stderr = Popen(cmd, stdout=PIPE, stderr=PIPE).communicate()
-        stdout = stdout.decode(UTF8)
-        stderr = stderr.decode(UTF8)
-        t1 = time.time()
+        for catapult in catapults:
+            latency, error = catapult.ping()
+            t = round(latency, 4)
+            socket_attr = " socket='%s'" % escape(catapult.socket_file) if several else ""
+            if error is None:
+                percentiles = "".join(" latency-p%s='%s'" % (p, round(v, 4))
+                                      for p, v in catapult.latency_percentiles())
+                xml += catapult_msg % (socket_attr, t, percentiles)
+            else:
+                failed = True
+                xml += catapult_error_msg % (socket_attr, t, "", escape(error))
     except BaseException as e:
         xml = "<error>Failed to ping catapult: %s</error>\n" % e
         return Response(xml, mimetype='application/xml')
-    else:
-        t = round(t1 - t0, 4)
-        if not stderr and stdout == "PONG":
-            xml = "<catapult time='%s'>%s</catapult>\n" % (t, stdout)
-        else:
-            xml = ping_error_msg % (t, stdout, stderr)
-        return Response(xml, mimetype='application/xml')
+    if failed:
+        xml = "<error>\n%s</error>" % xml
+    elif several:
+        xml = "<catapults>\n%s</catapults>\n" % xml
+    return Response(xml, mimetype='application/xml')
 
 
 @app.route('/schema')
 def schema():
-    """The /schema handler"""
+    """
+    The /schema handler.
+    The schema is sent with a strong ETag and supports conditional requests
+    (If-None-Match).
+    """
     lang = request.values.get('language', 'sv')
     mode = request.values.get('mode', 'plain')
-    return_json = make_schema(lang, mode)
-    # print(json.dumps(return_json, indent=4, separators=(',', ': '), ensure_ascii=False))
-    return Response(json.dumps(return_json),
-                    mimetype="application/json",
-                    content_type='application/json; charset=utf-8')
+    prepared = prepared_schema(lang, mode, request.values.get('ui_lang'))
+    response = Response(prepared.json,
+                        mimetype="application/json",
+                        content_type='application/json; charset=utf-8')
+    response.set_etag(prepared.etag)
+    return response.make_conditional(request)
 
 
 @app.route('/cleanup')
@@ -187,17 +303,19 @@ def cleanup(timeout=604800, remove_errors=False):
             if (finished(b.status) and time.time() - b.accessed_time > timeout or
                     b.status in [Status.Error, Status.ParseError] and remove_errors):
                 to_remove.append((h, b))
-        res = []
+        trashed = []
         for h, b in to_remove:
             log.info("Removing %s" % h)
-            b.remove_files()
-            del builds[h]
-            res.append("<removed hash='%s'/>" % h)
-        if len(res) == 0:
-            res = "<message>No hashes to be removed.</message>\n"
-        else:
-            res = "\n".join(res)
-            res = "<message>\n%s</message>\n" % res
+            trashed.append(builds.remove(h))
+        remove_stale_uploads(timeout)
+        if blob_store is not None:
+            # Original texts that no build uses anymore
+            blob_store.prune(timeout)
+        if annotation_cache is not None:
+            # Cached annotations that no build uses anymore
+            pruned = annotation_cache.prune(timeout)
+            log.info("Pruned %s entries from the annotation cache" % pruned)
+        res = removal_message([h for h, _b in to_remove], trashed)
     else:
         res = "<error>Failed to run cleanup: secret key could not be confirmed.</error>\n"
 
@@ -214,28 +332,20 @@ def cleanup_all():
     """Remove all the existing builds. Requires secret_key parameter in query."""
     builds = app.config["BUILDS"]
     to_remove = []
+    trashed = []
     secret_key = request.values.get('secret_key', '')
 
     if check_secret_key(secret_key):
         log.info("All builds will be removed.")
         build_dirs = get_build_directories(Config.builds_dir)
         for hashnumber in build_dirs:
-            b = builds.get(hashnumber, None)
             log.info("Removing %s" % hashnumber)
-            if b:
+            if hashnumber in builds:
                 to_remove.append(hashnumber)
-                b.remove_files()
+                trashed.append(builds.remove(hashnumber))
             else:
-                rmdir(os.path.join(Config.builds_dir, hashnumber))
-        res = []
-        for h in to_remove:
-            del builds[h]
-            res.append("<removed hash='%s'/>" % h)
-        if len(res) == 0:
-            res = "<message>No hashes to be removed.</message>\n"
-        else:
-            res = "\n".join(res)
-            res = "<message>\n%s</message>\n" % res
+                trashed.append(trash.move(os.path.join(Config.builds_dir, hashnumber)))
+        res = removal_message(to_remove, trashed)
     else:
         log.error("No builds will be removed.")
         res = "<error>Failed to remove all builds: secret key could not be confirmed.</error>\n"
@@ -255,17 +365,16 @@ def cleanup_one():
         return Response(res, mimetype='application/xml')
 
     if check_secret_key(secret_key):
-        b = builds.get(hash, None)
-        if b:
+        if hash in builds:
             log.info("Removing %s" % hash)
-            del builds[hash]
-            b.remove_files()
-            res = ("<message>\n<removed hash='%s'/>\n</message>" % hash)
+            res = removal_message([hash], [builds.remove(hash)])
         else:
             log.error("Hash not found, trying to remove files.")
             res = "<error>Failed to remove build: hash not found, trying to remove files.</error>\n"
             if hash in get_build_directories(Config.builds_dir):
-                rmdir(os.path.join(Config.builds_dir, hash))
+                trashed = trash.move(os.path.join(Config.builds_dir, hash))
+                if trashed is not None:
+                    trash.delete([trashed])
                 log.info("Files removed for hash %s" % hash)
             else:
                 log.info("No files to be removed for hash %s" % hash)
@@ -276,6 +385,27 @@ def cleanup_one():
     return Response(res, mimetype='application/xml')
 
 
+@app.route('/cleanup/job')
+def cleanup_job():
+    """
+    The progress of a job that deletes the files of removed builds.
+    Requires secret_key parameter in query.
+    """
+    secret_key = request.values.get('secret_key', '')
+    if check_secret_key(secret_key):
+        job = trash.job(request.values.get('id', ''))
+        if job is None:
+            res = "<error>No such deletion job!</error>\n"
+        else:
+            res = ("<deletion-job id='%s' state='%s' directories='%s' deleted='%s' created='%s'%s/>\n" %
+                   (job["id"], job["state"], job["directories"], job["deleted"],
+                    pretty_epoch_time(job["created"]),
+                    " finished='%s'" % pretty_epoch_time(job["finished"]) if job["finished"] else ""))
+    else:
+        res = "<error>Failed to show deletion job: secret key could not be confirmed.</error>\n"
+    return Response(res, mimetype='application/xml')
+
+
 @app.route('/makefile', methods=['GET', 'POST'])
 def get_makefile():
     """Handler for returning the makefile."""
@@ -307,21 +437,27 @@ def text_input():
         builds = app.config["BUILDS"]
         settings, incremental = get_settings(lang, mode)
 
-        def generate(mode, builds, txt, settings, incremental):
+        # Escape plain text and give it a root element
+        if mode == "plain":
+            txt = escape(txt)
+            txt = "<text>" + txt + "</text>"
+        # Check for empty input
+        if not txt:
+            log.error(ERROR_MSG["empty_input"])
+            res = "<result>\n<error>%s</error>\n</result>" % ERROR_MSG["empty_input"]
+            return Response(res, mimetype='application/xml')
+
+        # Start the build before responding, so that a full queue can be reported
+        nodes = build(builds, txt, settings, incremental, "xml")
+
+        def generate(nodes):
             yield "<result>\n".encode("UTF-8")
-            # Escape plain text and give it a root element
-            if mode == "plain":
-                txt = escape(txt)
-                txt = "<text>" + txt + "</text>"
-            # Check for empty input
-            if not txt:
-                log.exception(ERROR_MSG["empty_input"])
-                yield "<error>%s</error>\n</result>" % ERROR_MSG["empty_input"]
-            else:
-                for node in build(builds, txt, settings, incremental, "xml"):
-                    yield node
+            for node in nodes:
+                yield node
 
-        return Response(generate(mode, builds, txt, settings, incremental), mimetype='application/xml')
+        return Response(generate(nodes), mimetype='application/xml')
+    except QueueFull as e:
+        return queue_full_response(e)
     except:
         trace = make_trace()
         log.exception("Error in text input procedure")
@@ -329,6 +465,49 @@ def text_input():
         return Response(res, mimetype='application/xml')
 
 
+@app.route('/batch', methods=['POST'])
+def batch():
+    """
+    Handler for annotating many texts in one build.
+    The texts are sent as a JSON list of strings. The result of each text
+    is sent as XML or, with format=ndjson, as one JSON object per line.
+    """
+    try:
+        log.info("Starting a new build with batch procedure")
+        lang = request.values.get('language', 'sv')
+        mode = request.values.get('mode', 'plain')
+        fmt = request.values.get('format', 'xml')
+        builds = app.config["BUILDS"]
+        settings, incremental = get_settings(lang, mode)
+
+        error = None
+        try:
+            texts = json.loads(request.values.get('texts', '[]'))
+        except ValueError:
+            texts = None
+        if not isinstance(texts, list):
+            error = ERROR_MSG["not_text_list"]
+        elif not texts:
+            error = ERROR_MSG["empty_input"]
+        elif len(texts) > Config.batch_max_texts:
+            error = ERROR_MSG["too_many_texts"]
+        if error is not None:
+            log.error(error)
+            res = "<result>\n<error>%s</error>\n</result>" % error
+            return Response(res, mimetype='application/xml')
+
+        nodes = batch_procedure(builds, settings, mode, texts, incremental, fmt)
+        mimetype = 'application/x-ndjson' if fmt == "ndjson" else 'application/xml'
+        return Response(nodes, mimetype=mimetype)
+    except QueueFull as e:
+        return queue_full_response(e)
+    except:
+        trace = make_trace()
+        log.exception("Error in batch procedure")
+        res = '<result>\n<trace>' + escape(trace) + '</trace>\n</result>\n'
+        return Response(res, mimetype='application/xml')
+
+
 @app.route('/join', methods=['GET', 'POST'])
 def join():
     """Handler for joining an existing build."""
@@ -353,6 +532,30 @@ def join():
         return Response(res, mimetype='application/xml')
 
 
+@app.route('/cancel', methods=['GET', 'POST'])
+def cancel():
+    """
+    Handler for cancelling a build that has not finished.
+    Requires secret_key parameter in query.
+    """
+    builds = app.config["BUILDS"]
+    hashnumber = request.values.get('hash', '')
+    secret_key = request.values.get('secret_key', '')
+    if not check_secret_key(secret_key):
+        res = "<error>Failed to cancel build: secret key could not be confirmed.</error>\n"
+        return Response(res, mimetype='application/xml')
+    b = builds.get(hashnumber, None)
+    if b is None:
+        res = "<error>No such build!</error>\n"
+    elif finished(b.status):
+        res = "<error>The build has already finished.</error>\n"
+    else:
+        log.info("Cancelling %s" % hashnumber)
+        builds.cancel(hashnumber, "cancelled")
+        res = "<message>The build is being cancelled.</message>\n"
+    return Response(res, mimetype='application/xml')
+
+
 @app.route('/upload', methods=['GET', 'POST'])
 def file_upload():
     """Handler for file upload procedure."""
@@ -364,17 +567,21 @@ def file_upload():
         settings, _incremental = get_settings(lang, mode)
         uploaded_files = request.files.getlist("files[]")
 
-        files = []
-        for f in uploaded_files:
-            name = f.filename[:f.filename.rfind(".")]
-            text = f.read().decode(UTF8)
-            files.append((name, text))
-
-        def generate(builds, settings, files, email):
-            for node in upload_procedure(builds, settings, files, email):
-                yield node
-
-        return Response(generate(builds, settings, files, email), mimetype='application/xml')
+        # Stream the files to disk instead of reading them into memory
+        files = None
+        if uploaded_files:
+            files = UploadSpool()
+            try:
+                for f in uploaded_files:
+                    name = f.filename[:f.filename.rfind(".")]
+                    files.add(name, f.stream)
+            except:
+                files.discard()
+                raise
+
+        return Response(upload_procedure(builds, settings, files, email), mimetype='application/xml')
+    except QueueFull as e:
+        return queue_full_response(e)
     except:
         trace = make_trace()
         log.exception("Error in /upload")
@@ -384,25 +591,39 @@ def file_upload():
 
 @app.route('/download')
 def download():
-    """The /download handler."""
+    """
+    The /download handler.
+    The file is sent with an ETag and supports conditional requests
+    (If-None-Match) and Range requests, so that downloads can be resumed.
+    """
     hashnumber = request.values.get('hash', '')
     builds = app.config["BUILDS"]
-    build = builds[hashnumber]
-
-    # Serve zip file or xml
-    if build.files:
-        filepath = build.directory
-        filename = build.zipfile
-        attachment_filename = "korpus.zip"
-        mimetype = 'application/zip'
-    else:
-        filepath = build.export_dir
-        filename = build.result_file
-        attachment_filename = "korpus.xml"
-        mimetype = 'application/xml'
+    build = builds.get(hashnumber, None)
+    if build is None or build.status != Status.Done:
+        res = "<error>No such build!</error>\n"
+        return Response(res, status=404, mimetype='application/xml')
+
+    build.access()
+    # The file is open once the response has been made, so it can be sent to
+    # the end even if the build is packed meanwhile. With X-Sendfile the web
+    # server opens it later, so builds are not packed then (see cold_storage)
+    with build.hot_files():
+        # Serve zip file or xml
+        if build.files:
+            # Builds from before zip files were made at build time
+            build.zip_result()
+            filepath = build.directory
+            filename = build.zipfile
+            attachment_filename = "korpus.zip"
+            mimetype = 'application/zip'
+        else:
+            filepath = build.export_dir
+            filename = build.result_file
+            attachment_filename = "korpus.xml"
+            mimetype = 'application/xml'
 
-    return send_from_directory(filepath, filename, mimetype=mimetype,
-                               as_attachment=True, attachment_filename=attachment_filename)
+        return send_from_directory(filepath, filename, mimetype=mimetype, conditional=True,
+                                   as_attachment=True, attachment_filename=attachment_filename)
 
 
 @app.route('/easteregg')
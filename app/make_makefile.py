@@ -2,10 +2,16 @@
 
 from builtins import str, map, zip, range
 from past.builtins import basestring
+import copy
+import functools
 import re
 import json
 from utils import TOOL_DICT
 import logging
+try:
+    from config import Config
+except ImportError:
+    from config_default import Config
 log = logging.getLogger('pipeline.' + __name__)
 
 DEFAULT_ROOT = "text"
@@ -220,18 +226,24 @@ def collect_children(indata):
 
 
 def remove_order(indata):
-    """Recursively remove order attribute from indata dict."""
+    """A copy of indata without the order attributes of its dicts."""
     if isinstance(indata, dict):
-        for k, v in indata.items():
-            if k == "order":
-                indata.pop("order")
-            for child_val in remove_order(v):
-                yield child_val
-    elif isinstance(indata, list):
-        for i in indata:
-            yield i
-    else:
-        yield indata
+        return dict((k, remove_order(v)) for k, v in indata.items() if k != "order")
+    return copy.deepcopy(indata)
+
+
+def clean_settings(settings):
+    """
+    A copy of settings without the order attributes (only needed by the
+    frontend for display of settings) and with the root tag filled in.
+    """
+    settings = remove_order(settings)
+    if 'root' not in settings:
+        settings['root'] = {
+            'tag': DEFAULT_ROOT,
+            'attributes': []
+        }
+    return settings
 
 ######################################
 
@@ -247,8 +259,7 @@ def make_Makefile(settings):
         lang = 'sv'
     analysis = TOOL_DICT[lang]
 
-    # Remove order attribute (only needed by the frontend for display of settings)
-    [i for i in remove_order(settings)]
+    settings = clean_settings(settings)
 
     # vrt_structs[_annotations]
     structs = []
@@ -261,14 +272,7 @@ def make_Makefile(settings):
     columns.insert(0, ('word', 'word'))
 
     # The root tag
-    if 'root' in settings:
-        text = settings['root'].get('tag', DEFAULT_ROOT)
-    else:
-        settings['root'] = {
-            'tag': DEFAULT_ROOT,
-            'attributes': []
-        }
-        text = DEFAULT_ROOT
+    text = settings['root'].get('tag', DEFAULT_ROOT)
 
     # Initial parents. All tags are assumed to have the root node as parent
     parents = []
@@ -386,8 +390,18 @@ def make_Makefile(settings):
 
 
 def makefile(d):
-    """Wrapper function for make_Makefile."""
-    return str(linearise_Makefile(make_Makefile(d)))
+    """
+    Wrapper function for make_Makefile. The makefiles of the most recently
+    used settings are kept in memory.
+    """
+    # The key order is kept, since it decides the order of some makefile rows
+    return cached_makefile(json.dumps(d, separators=(',', ':')))
+
+
+@functools.lru_cache(maxsize=Config.makefile_cache_size)
+def cached_makefile(settings_json):
+    """The makefile for settings given as JSON."""
+    return str(linearise_Makefile(make_Makefile(json.loads(settings_json))))
 
 
 ##########################################
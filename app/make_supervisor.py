@@ -0,0 +1,57 @@
+# Supervision of running make processes. The standard output and the
+# standard error of make are read together as data arrives, so that make
+# never blocks on a full pipe, however much an annotator writes to either.
+
+from builtins import object
+import os
+import selectors
+
+from utils import UTF8
+
+# The number of bytes read from a pipe at a time
+READ_SIZE = 64 * 1024
+
+
+class MakeSupervisor(object):
+    """
+    Iterate over the lines that a make process writes to stdout, while
+    collecting what it writes to stderr. Iteration ends when make has
+    closed both streams.
+    """
+
+    def __init__(self, process):
+        self.process = process
+        self.stderr_chunks = []
+        self._lines = self._read()
+
+    def __iter__(self):
+        return self._lines
+
+    def _read(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.process.stdout, selectors.EVENT_READ)
+        selector.register(self.process.stderr, selectors.EVENT_READ)
+        open_streams = 2
+        pending = b""
+        try:
+            while open_streams:
+                for key, _events in selector.select():
+                    data = os.read(key.fd, READ_SIZE)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        open_streams -= 1
+                    elif key.fileobj is self.process.stdout:
+                        lines = (pending + data).split(b"\n")
+                        pending = lines.pop()
+                        for line in lines:
+                            yield line.decode(UTF8) + "\n"
+                    else:
+                        self.stderr_chunks.append(data)
+            if pending:
+                yield pending.decode(UTF8)
+        finally:
+            selector.close()
+
+    def stderr(self):
+        """What make has written to stderr so far."""
+        return b"".join(self.stderr_chunks).decode(UTF8, "replace")
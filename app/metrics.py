@@ -0,0 +1,202 @@
+# Metrics of the web tier and the builds, exposed in the Prometheus text
+# format by /metrics.
+#
+# Counters and histograms are kept in shards, one per thread. A thread only
+# updates its own shard, so updates take no lock. The shards are summed up
+# when the metrics are collected. The metrics are those of one worker process.
+
+from builtins import object
+from bisect import bisect_left
+from threading import Lock, Thread, current_thread, local
+import itertools
+import logging
+import os
+import time
+
+log = logging.getLogger('pipeline.' + __name__)
+
+PREFIX = "sparv_"
+
+# Upper bounds (in seconds) of the buckets of the request duration histogram
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Numbers the requests for the log. Taking the next number is atomic.
+request_numbers = itertools.count(1)
+
+
+class Metrics(object):
+    """
+    Counters and histograms, keyed by name and a tuple of label pairs.
+    A histogram value is a list of bucket counts (the last bucket for values
+    above all bounds) followed by the sum of the observed values.
+    """
+
+    def __init__(self):
+        self.local = local()
+        # (thread, shard) for every thread that has updated a metric
+        self.shards = []
+        # The sums of the shards of threads that have ended
+        self.retired = {}
+        self.bounds = {}
+        self.help = {}
+        # Only taken when a thread updates its first metric, and on collection
+        self.lock = Lock()
+
+    def _shard(self):
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append((current_thread(), shard))
+        return shard
+
+    def counter(self, name, help_text):
+        self.help[name] = ("counter", help_text)
+
+    def histogram(self, name, help_text, bounds):
+        self.help[name] = ("histogram", help_text)
+        self.bounds[name] = bounds
+
+    def inc(self, name, labels=(), amount=1):
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        shard = self._shard()
+        key = (name, labels)
+        h = shard.get(key)
+        if h is None:
+            h = shard[key] = [0] * (len(self.bounds[name]) + 2)
+        h[bisect_left(self.bounds[name], value)] += 1
+        h[-1] += value
+
+    @staticmethod
+    def _add(total, shard):
+        for key, value in shard.items():
+            if isinstance(value, list):
+                if key in total:
+                    total[key] = [a + b for a, b in zip(total[key], value)]
+                else:
+                    total[key] = list(value)
+            else:
+                total[key] = total.get(key, 0) + value
+
+    def collect(self):
+        """Sum up the shards. Return a dict from (name, labels) to value."""
+        with self.lock:
+            alive = []
+            for thread, shard in self.shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    self._add(self.retired, shard)
+            self.shards = alive
+            total = {}
+            self._add(total, self.retired)
+            for _thread, shard in alive:
+                # Copying a dict is atomic, so the owner may go on updating it
+                self._add(total, shard.copy())
+        return total
+
+    def render(self, gauges):
+        """
+        Render the counters and histograms, followed by gauges, a list of
+        (name, help text, [(labels, value)]), in the Prometheus text format.
+        """
+        values = self.collect()
+        lines = []
+        for name in sorted(self.help):
+            kind, help_text = self.help[name]
+            lines.append("# HELP %s%s %s" % (PREFIX, name, help_text))
+            lines.append("# TYPE %s%s %s" % (PREFIX, name, kind))
+            for (n, labels), value in sorted(values.items()):
+                if n != name:
+                    continue
+                if kind == "counter":
+                    lines.append("%s%s%s %s" % (PREFIX, name, format_labels(labels), value))
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.bounds[name] + ["+Inf"], value[:-1]):
+                    cumulative += count
+                    lines.append("%s%s_bucket%s %s" % (PREFIX, name, format_labels(labels + (("le", bound),)),
+                                                       cumulative))
+                lines.append("%s%s_sum%s %s" % (PREFIX, name, format_labels(labels), value[-1]))
+                lines.append("%s%s_count%s %s" % (PREFIX, name, format_labels(labels), cumulative))
+        for name, help_text, samples in gauges:
+            lines.append("# HELP %s%s %s" % (PREFIX, name, help_text))
+            lines.append("# TYPE %s%s gauge" % (PREFIX, name))
+            for labels, value in samples:
+                lines.append("%s%s%s %s" % (PREFIX, name, format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append('%s="%s"' % (key, value))
+    return "{%s}" % ",".join(pairs)
+
+
+class DiskUsage(object):
+    """
+    The number of bytes used by the files under a directory, recounted at
+    most every max_age seconds. The files are counted in a background
+    thread, so that get() never waits for a count.
+    """
+
+    def __init__(self, directory, max_age):
+        self.directory = directory
+        self.max_age = max_age
+        self.counted_at = 0
+        self.used = 0
+        self.lock = Lock()
+        self.counter = None
+
+    def get(self):
+        """The latest count, 0 until the first count is done. A new count is started if it is too old."""
+        with self.lock:
+            if self.counter is None and time.time() - self.counted_at > self.max_age:
+                self.counter = Thread(target=self._recount, name="disk-usage")
+                self.counter.daemon = True
+                self.counter.start()
+            return self.used
+
+    def _recount(self):
+        try:
+            used = self._count()
+            with self.lock:
+                self.used = used
+                self.counted_at = time.time()
+        except:
+            log.exception("Could not count the disk usage of %s", self.directory)
+        finally:
+            with self.lock:
+                self.counter = None
+
+    def _count(self):
+        used = 0
+        # Hard linked files are counted once
+        seen = set()
+        for root, _dirs, files in os.walk(self.directory):
+            for f in files:
+                try:
+                    st = os.lstat(os.path.join(root, f))
+                except OSError:
+                    continue
+                if st.st_nlink > 1:
+                    if st.st_ino in seen:
+                        continue
+                    seen.add(st.st_ino)
+                used += st.st_size
+        return used
+
+
+metrics = Metrics()
+metrics.counter("requests_total", "Requests handled, by route, method and status code.")
+metrics.histogram("request_duration_seconds", "Time until the response to a request started, by route.",
+                  DURATION_BUCKETS)
+metrics.counter("build_status_changes_total", "Status changes of the builds run by this process, by new status.")
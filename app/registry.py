@@ -0,0 +1,387 @@
+# Registry of the builds, shared between the worker processes of the web
+# server. The state of every build is kept in an SQLite database under
+# builds_dir, so that any worker can look up, join and deduplicate a build,
+# no matter which worker runs it.
+#
+# A build is run by the process that registered it, its owner. Every process
+# holds an exclusive lock on an owner file for as long as it lives, so the
+# builds of a dead process can be told apart and taken over. Other processes
+# see a build through a proxy Build, which is refreshed from the database
+# while someone is watching it. A build is cancelled through the database too,
+# and its owner stops it. Scans of all builds only see snapshots of the rows,
+# so that no Build has to be made for them.
+
+from builtins import object
+from threading import RLock, Thread, local
+import fcntl
+import logging
+import os
+import sqlite3
+import time
+import uuid
+
+from access_journal import access_journal
+from build import Build
+from enums import Status, finished
+from scheduler import scheduler
+from utils import mkdir
+try:
+    from config import Config
+except ImportError:
+    from config_default import Config
+
+log = logging.getLogger('pipeline.' + __name__)
+
+# The columns that are copied from an owned build to the database
+STATE_COLUMNS = ["fmt", "status", "status_change_time", "command", "step", "steps",
+                 "queue_position", "expected_wait", "trace", "stdout", "stderr"]
+
+ADDED_COLUMNS = [
+    # Why the build was cancelled, or has been asked to be cancelled
+    ("cancel_reason", "TEXT"),
+    # When a client of any process was last waiting for the build
+    ("watched_at", "REAL"),
+]
+
+# A build is in use while a client has been waiting for it within this many poll intervals
+WATCHED_POLLS = 3
+
+
+class BuildRow(object):
+    """A snapshot of the registered state of a build, as returned by BuildRegistry.items()."""
+
+    def __init__(self, row, listeners):
+        self.build_hash = row["hash"]
+        self.owner = row["owner"]
+        self.fmt = row["fmt"]
+        self.status = row["status"]
+        self.status_change_time = row["status_change_time"]
+        self.watched_at = row["watched_at"]
+        # Clients of this process that are waiting for the build
+        self.listeners = listeners
+        self.directory = os.path.join(Config.builds_dir, self.build_hash)
+        self.manifest_file = os.path.join(self.directory, "manifest.json")
+
+    def in_use(self):
+        """Check if a client of any process is waiting for this build."""
+        recent = time.time() - WATCHED_POLLS * Config.registry_poll_interval
+        return bool(self.listeners) or (self.watched_at or 0) > recent
+
+    @property
+    def accessed_time(self):
+        """When this build was last accessed."""
+        t = access_journal.get(self.build_hash)
+        if t is None:
+            # Builds accessed before the journal was kept have an accessed file
+            try:
+                t = os.path.getmtime(os.path.join(self.directory, "accessed"))
+            except OSError:
+                t = self.status_change_time or time.time()
+            access_journal.touch(self.build_hash, t)
+        return t
+
+
+class BuildRegistry(object):
+    """
+    A dict-like registry of builds, keyed by build hash.
+
+    The builds that this process owns are returned as they are, the other
+    ones as proxies. The registry must be created in the process that uses
+    it, i.e. in the gunicorn worker and not before forking.
+    """
+
+    def __init__(self, directory, poll_interval):
+        self.directory = directory
+        self.owners_dir = os.path.join(directory, "owners")
+        mkdir(self.owners_dir)
+        self.db_path = os.path.join(directory, "builds.sqlite")
+        self.poll_interval = poll_interval
+        self.owner = "%s-%s" % (os.getpid(), uuid.uuid4().hex[:8])
+        self.owner_file = self._lock_owner_file(self.owner)
+        # The Build objects of this process, both owned builds and proxies
+        self.local_builds = {}
+        self.lock = RLock()
+        self.connections = local()
+        self.poller = None
+
+        db = self._db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS builds ("
+                   "hash TEXT PRIMARY KEY, owner TEXT, fmt TEXT, status INTEGER, "
+                   "status_change_time REAL, command TEXT, step INTEGER, steps INTEGER, "
+                   "queue_position INTEGER, expected_wait INTEGER, "
+                   "trace TEXT, stdout TEXT, stderr TEXT)")
+        # Columns added after the table was first created
+        columns = [row[1] for row in db.execute("PRAGMA table_info(builds)")]
+        for column, column_type in ADDED_COLUMNS:
+            if column not in columns:
+                db.execute("ALTER TABLE builds ADD COLUMN %s %s" % (column, column_type))
+
+    def _db(self):
+        """The database connection of the current thread."""
+        db = getattr(self.connections, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.connections.db = db
+        return db
+
+    def _lock_owner_file(self, owner):
+        f = open(os.path.join(self.owners_dir, owner + ".lock"), "w")
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return f
+
+    def _alive(self, owner):
+        """Check if the process that registered as owner is still running."""
+        if owner == self.owner:
+            return True
+        path = os.path.join(self.owners_dir, owner + ".lock")
+        try:
+            f = open(path, "r")
+        except IOError:
+            return False
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return True
+            # Nobody holds the lock any longer
+            os.remove(path)
+            return False
+
+    def _row(self, build_hash):
+        return self._db().execute("SELECT * FROM builds WHERE hash = ?", (build_hash,)).fetchone()
+
+    def _own(self, build_hash, build):
+        """Register build as owned by this process. Must be called within a transaction."""
+        state = [getattr(build, "fmt", None), build.status, build.status_change_time]
+        self._db().execute("INSERT OR REPLACE INTO builds (hash, owner, fmt, status, status_change_time) "
+                           "VALUES (?, ?, ?, ?, ?)", [build_hash, self.owner] + state)
+        build.registry = self
+        self.local_builds[build_hash] = build
+        self._start_poller()
+
+    def claim(self, build_hash, build):
+        """
+        Make this process the owner of build, unless the build is registered
+        by a live process already or has finished. Cancelled builds may be
+        claimed again. Return True if the build was claimed.
+        """
+        with self.lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._row(build_hash)
+                if row is not None and row["status"] != Status.Cancelled and \
+                        (finished(row["status"]) or self._alive(row["owner"])):
+                    db.execute("ROLLBACK")
+                    return False
+                self._own(build_hash, build)
+                db.execute("COMMIT")
+            except:
+                db.execute("ROLLBACK")
+                raise
+        if row is not None and row["owner"] != self.owner:
+            log.info("Took over build %s from %s", build_hash, row["owner"])
+        return True
+
+    def setdefault(self, build_hash, build):
+        """
+        Register build unless the same build is registered already.
+        Return the registered build.
+        """
+        while not self.claim(build_hash, build):
+            existing = self.get(build_hash)
+            if existing is not None:
+                return existing
+        return build
+
+    def stored_state(self, build_hash):
+        """The registered (status, format) of a build, or None if it is not registered."""
+        row = self._row(build_hash)
+        if row is None:
+            return None
+        return row["status"], row["fmt"]
+
+    def save(self, build):
+        """Store the state of an owned build."""
+        values = [getattr(build, column, None) for column in STATE_COLUMNS]
+        # A cancellation asked for by another process is kept until the build sees it
+        self._db().execute("UPDATE builds SET %s, cancel_reason = COALESCE(?, cancel_reason) "
+                           "WHERE hash = ? AND owner = ?"
+                           % ", ".join("%s = ?" % c for c in STATE_COLUMNS),
+                           values + [build.cancel_reason, build.build_hash, self.owner])
+
+    def cancel(self, build_hash, reason):
+        """Cancel a build, or ask the process that owns it to cancel it."""
+        with self.lock:
+            build = self.local_builds.get(build_hash)
+        if build is not None and build.registry is self:
+            build.cancel(reason)
+        else:
+            self._db().execute("UPDATE builds SET cancel_reason = COALESCE(cancel_reason, ?) WHERE hash = ?",
+                               (reason, build_hash))
+
+    def get(self, build_hash, default=None):
+        row = self._row(build_hash)
+        with self.lock:
+            if row is None:
+                self.local_builds.pop(build_hash, None)
+                return default
+            return self._build_for(row)
+
+    def _build_for(self, row):
+        """The local Build for a database row. Must be called with the lock held."""
+        build = self.local_builds.get(row["hash"])
+        if build is not None and build.registry is self and row["owner"] != self.owner:
+            # Restarted by another process after it was cancelled here
+            build = None
+        if build is None:
+            build = Build(None, None, init_from_hash=row["hash"], resuming=True)
+            self.local_builds[row["hash"]] = build
+            self._refresh(build, row)
+            self._start_poller()
+        elif build.registry is None:
+            self._refresh(build, row)
+        return build
+
+    def _refresh(self, proxy, row):
+        """Update a proxy from its database row and notify its listeners."""
+        increment = (row["command"] or "", row["step"] or 0, row["steps"] or 0,
+                     row["queue_position"] or 0, row["expected_wait"] or 0)
+        if increment != (proxy.command, proxy.step, proxy.steps, proxy.queue_position, proxy.expected_wait):
+            proxy.command, proxy.step, proxy.steps, proxy.queue_position, proxy.expected_wait = increment
+            proxy.hub.publish_increment(proxy.increment_msg())
+        if row["status"] != proxy.status:
+            if finished(row["status"]):
+                # Prepare the result before the listeners ask for it
+                proxy.set_outputs(row["fmt"] or "xml")
+                proxy.read_warnings()
+                proxy.trace, proxy.stdout, proxy.stderr = (row["trace"] or "", row["stdout"] or "",
+                                                           row["stderr"] or "")
+                proxy.cancel_reason = row["cancel_reason"]
+            proxy.status = row["status"]
+            proxy.status_change_time = row["status_change_time"]
+            proxy.hub.publish_status(proxy.status)
+
+    def _start_poller(self):
+        """Start the thread that refreshes proxies. Must be called with the lock held."""
+        if self.poller is None:
+            self.poller = Thread(target=self._poll, name="registry-poller")
+            self.poller.daemon = True
+            self.poller.start()
+
+    def _poll(self):
+        """
+        Refresh the watched proxies and take over the builds of dead processes.
+        Stop owned builds that have been cancelled or removed, have run for
+        too long, or that nobody has waited for in a while.
+        """
+        while True:
+            time.sleep(self.poll_interval)
+            with self.lock:
+                watched = [(h, b) for h, b in self.local_builds.items()
+                           if b.registry is None and b.hub.listeners and not finished(b.status)]
+                owned = [(h, b) for h, b in self.local_builds.items()
+                         if b.registry is self and not finished(b.status)]
+            now = time.time()
+            for build_hash, proxy in watched:
+                try:
+                    row = self._row(build_hash)
+                    if row is None:
+                        continue
+                    if not self._alive(row["owner"]) and self.claim(build_hash, proxy):
+                        scheduler.submit(proxy, row["fmt"] or "xml", force=True)
+                    else:
+                        self._db().execute("UPDATE builds SET watched_at = ? WHERE hash = ?", (now, build_hash))
+                        with self.lock:
+                            self._refresh(proxy, row)
+                except:
+                    log.exception("Could not refresh build %s", build_hash)
+            for build_hash, build in owned:
+                try:
+                    row = self._row(build_hash)
+                    if row is None:
+                        # Removed by another process, see remove()
+                        build.cancel("cancelled")
+                    else:
+                        self._supervise(build, row, now)
+                except:
+                    log.exception("Could not supervise build %s", build_hash)
+
+    def _supervise(self, build, row, now):
+        if build.hub.listeners:
+            build.last_watched = now
+            # Seen by the other processes, see BuildRow.in_use
+            self._db().execute("UPDATE builds SET watched_at = ? WHERE hash = ?", (now, build.build_hash))
+        last_watched = max(build.last_watched or 0, row["watched_at"] or 0)
+        if row["cancel_reason"]:
+            build.cancel(row["cancel_reason"])
+        elif Config.build_timeout is not None and build.started_time and \
+                now - build.started_time > Config.build_timeout:
+            build.cancel("timeout")
+        elif Config.abandoned_build_grace is not None and not build.files and \
+                last_watched and now - last_watched > Config.abandoned_build_grace:
+            # Only text builds are stopped, results of uploads can be fetched later
+            build.cancel("abandoned")
+
+    def status_counts(self):
+        """The number of registered builds with each status."""
+        rows = self._db().execute("SELECT status, COUNT(*) FROM builds GROUP BY status").fetchall()
+        return dict((row[0], row[1]) for row in rows)
+
+    def listener_count(self):
+        """The number of clients of this process that are waiting for builds."""
+        with self.lock:
+            return sum(b.hub.listeners for b in self.local_builds.values())
+
+    def __contains__(self, build_hash):
+        return self._row(build_hash) is not None
+
+    def __getitem__(self, build_hash):
+        build = self.get(build_hash)
+        if build is None:
+            raise KeyError(build_hash)
+        return build
+
+    def __setitem__(self, build_hash, build):
+        with self.lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                self._own(build_hash, build)
+                db.execute("COMMIT")
+            except:
+                db.execute("ROLLBACK")
+                raise
+
+    def __delitem__(self, build_hash):
+        with self.lock:
+            self._db().execute("DELETE FROM builds WHERE hash = ?", (build_hash,))
+            self.local_builds.pop(build_hash, None)
+
+    def remove(self, build_hash):
+        """
+        Move the files of a build to the trash and unregister it. A build that
+        has not finished is cancelled first, so that it stops running in its
+        trashed directory. Return the trashed directory, or None if the build
+        has no files.
+        """
+        build = self.get(build_hash)
+        if build is not None and not finished(build.status):
+            # The process that owns the build cancels it when it sees that it is gone
+            self.cancel(build_hash, "cancelled")
+        trashed = build.remove_files() if build is not None else None
+        del self[build_hash]
+        return trashed
+
+    def items(self):
+        """The registered builds, as a list of (hash, BuildRow)."""
+        rows = self._db().execute("SELECT * FROM builds").fetchall()
+        with self.lock:
+            listeners = dict((h, b.hub.listeners) for h, b in self.local_builds.items())
+        return [(row["hash"], BuildRow(row, listeners.get(row["hash"], 0))) for row in rows]
+
+
+registry = BuildRegistry(Config.registry_dir, Config.registry_poll_interval)
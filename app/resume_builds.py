@@ -1,11 +1,17 @@
 # Resumes builds that are in the pipeline directory when the script needs to
-# restart. Starts make in the corresponding directories in case they had
-# not finished.
+# restart. Finished builds are not touched: they are looked up in the registry
+# when they are asked for. Builds that had not finished are queued on the
+# build slots of the scheduler, unless another worker process has resumed
+# them already.
 
 from threading import Thread
 import logging
+import time
 
 from build import Build
+from enums import finished
+from registry import registry
+from scheduler import scheduler
 from utils import get_build_directories
 try:
     from config import Config
@@ -15,14 +21,41 @@ except ImportError:
 log = logging.getLogger('pipeline.' + __name__)
 
 
-def resume_builds():
-    builds = {}
+def resume_build(build_hash):
+    """
+    Resume one build. Return "finished", "resumed" or None if the build
+    is handled by another process.
+    """
+    state = registry.stored_state(build_hash)
+    if state is not None and finished(state[0]):
+        return "finished"
+
+    fmt = state[1] if state is not None and state[1] else "xml"
+    build = Build(None, None, init_from_hash=build_hash, resuming=True)
+    if not registry.claim(build_hash, build):
+        return None
+
+    if state is None and build.restore_status():
+        # Finished before the build was registered, so make need not run again
+        registry.save(build)
+        return "finished"
 
+    log.info("Reattaching build in directory %s", build_hash)
+    scheduler.submit(build, fmt, force=True)
+    return "resumed"
+
+
+def resume_builds():
     def resume_worker():
+        t0 = time.time()
+        counts = {"finished": 0, "resumed": 0, None: 0}
         for d in get_build_directories(Config.builds_dir):
-            log.info("Reattaching build in directory %s", d)
-            build = builds[d] = Build(None, None, init_from_hash=d, resuming=True)
-            Build.run(build, 'xml')
+            try:
+                counts[resume_build(d)] += 1
+            except:
+                log.exception("Failed to resume build %s", d)
+        log.info("Resumed builds in %.2f seconds: %d finished, %d queued, %d handled by other processes",
+                 time.time() - t0, counts["finished"], counts["resumed"], counts[None])
     t = Thread(target=resume_worker, args=[])
     t.start()
-    return builds
+    return registry
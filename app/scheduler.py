@@ -0,0 +1,166 @@
+# Schedules builds on a fixed number of build slots. Builds that cannot start
+# right away wait in a bounded queue, and new builds are refused when the
+# queue is full.
+
+from builtins import object
+from collections import deque
+from threading import Condition, Lock, Thread
+import logging
+import math
+import time
+
+from utils import ERROR_MSG
+try:
+    from config import Config
+except ImportError:
+    from config_default import Config
+
+log = logging.getLogger('pipeline.' + __name__)
+
+
+class QueueFull(Exception):
+    """Raised when a build cannot be admitted because the wait queue is full."""
+
+    # The key of ERROR_MSG that tells the client why
+    reason = "queue_full"
+
+    def __init__(self, retry_after):
+        super(QueueFull, self).__init__(ERROR_MSG[self.reason])
+        self.retry_after = retry_after
+
+
+class BuildScheduler(object):
+    """
+    Run builds on a fixed number of slots.
+
+    Every slot is a worker thread that runs one build at a time. Builds that
+    do not get a slot wait in a FIFO queue and are told their queue position
+    and expected waiting time whenever the queue moves. The positions are
+    taken with the queue locked, but told after it is unlocked, since telling
+    a build saves its state.
+    """
+
+    def __init__(self, slots, queue_size, duration_estimate):
+        self.slots = slots
+        self.queue_size = queue_size
+        # Moving average of the time a build occupies a slot
+        self.avg_duration = float(duration_estimate)
+        self.waiting = deque()
+        self.running = 0
+        # Builds that have been admitted but are not queued yet
+        self.reserved = 0
+        self.cond = Condition()
+        self.workers = []
+        # Queue positions are numbered, so that older ones are never told after newer ones
+        self.positions_taken = 0
+        self.positions_told = 0
+        self.announce_lock = Lock()
+
+    def submit(self, build, fmt, prepare=None, force=False):
+        """
+        Queue a build for running with format fmt.
+        prepare is called before the build is queued, once a place in the
+        queue has been reserved for it. Raises QueueFull if there is no room
+        for the build, unless force is set.
+        """
+        with self.cond:
+            occupied = self.running + len(self.waiting) + self.reserved
+            if not force and occupied >= self.slots + self.queue_size:
+                log.warning("Build queue is full, refusing %s", build.build_hash)
+                raise QueueFull(self.retry_after())
+            self.reserved += 1
+
+        try:
+            if prepare is not None:
+                prepare()
+        except:
+            with self.cond:
+                self.reserved -= 1
+            raise
+
+        with self.cond:
+            self.reserved -= 1
+            self.waiting.append((build, fmt))
+            self._start_workers()
+            positions = self._positions()
+            self.cond.notify()
+        self._announce(positions)
+
+    def cancel(self, build):
+        """Take a waiting build out of the queue. Return True if it was waiting."""
+        with self.cond:
+            for i, (waiting_build, _fmt) in enumerate(self.waiting):
+                if waiting_build is build:
+                    del self.waiting[i]
+                    positions = self._positions()
+                    break
+            else:
+                return False
+        self._announce(positions)
+        return True
+
+    def queue_depth(self):
+        """The number of builds waiting for a slot."""
+        return len(self.waiting)
+
+    def expected_wait(self, position):
+        """The expected number of seconds until the build at position gets a slot."""
+        rounds = int(math.ceil(position / float(self.slots)))
+        return int(round(rounds * self.avg_duration))
+
+    def retry_after(self):
+        """The number of seconds a refused client should wait before retrying."""
+        return max(1, int(round(self.avg_duration / self.slots)))
+
+    def _start_workers(self):
+        """Start the slot threads. Must be called with the lock held."""
+        while len(self.workers) < self.slots:
+            t = Thread(target=self._worker, name="build-slot-%d" % len(self.workers))
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def _positions(self):
+        """
+        Take the queue positions of the waiting builds, to be told with
+        _announce. Must be called with the lock held.
+        """
+        self.positions_taken += 1
+        return self.positions_taken, [(build, position, self.expected_wait(position))
+                                      for position, (build, _fmt) in enumerate(self.waiting, start=1)]
+
+    def _announce(self, positions):
+        """Tell the waiting builds about their queue positions. Must be called without the lock held."""
+        number, builds = positions
+        with self.announce_lock:
+            if number < self.positions_told:
+                # Newer positions have been told already
+                return
+            self.positions_told = number
+            for build, position, expected_wait in builds:
+                build.change_queue_position(position, expected_wait)
+
+    def _worker(self):
+        """Run queued builds, one at a time."""
+        while True:
+            with self.cond:
+                while not self.waiting:
+                    self.cond.wait()
+                build, fmt = self.waiting.popleft()
+                self.running += 1
+                positions = self._positions()
+            self._announce(positions)
+
+            t0 = time.time()
+            try:
+                build.run(fmt)
+            except:
+                log.exception("Error in build slot")
+            finally:
+                duration = time.time() - t0
+                with self.cond:
+                    self.running -= 1
+                    self.avg_duration = 0.8 * self.avg_duration + 0.2 * duration
+
+
+scheduler = BuildScheduler(Config.build_slots, Config.build_queue_size, Config.build_duration_estimate)
@@ -1,13 +1,24 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
+from builtins import object
 from utils import TOOL_DICT
+from schema_utils import CompiledValidator
 from collections import OrderedDict
+import copy
+import hashlib
 import json
 import logging
 
 log = logging.getLogger('pipeline.' + __name__)
 
+# The text modes that schemas are prepared for
+MODES = ["plain", "xml", "file"]
+
+# The languages of the titles and descriptions in the schema. English ones
+# have no suffix, the others are suffixed with the language, e.g. title_sv.
+UI_LANGUAGES = ["en", "sv"]
+
 
 def make_schema(lang, mode):
     """Build settings schema json."""
@@ -35,6 +46,9 @@ def make_schema(lang, mode):
             ("text_attributes", text_attributes(lang))
         ]))
     ])
+    # Parts of the schema are module level dicts, which must not be changed
+    schema = copy.deepcopy(schema)
+
     # Remove entries with None values
     [i for i in remove_nones(schema)]
 
@@ -576,6 +590,80 @@ def add_order(json_input):
                 yield child_val
 
 
+def trim_schema(json_input, ui_lang):
+    """
+    A copy of a schema without the titles and descriptions in other languages
+    than ui_lang. An English title or description is kept where there is none
+    in ui_lang, as a fallback.
+    """
+    if isinstance(json_input, dict):
+        suffixes = tuple("_" + l for l in UI_LANGUAGES if l != ui_lang and l != "en")
+        trimmed = OrderedDict() if isinstance(json_input, OrderedDict) else {}
+        for k, v in json_input.items():
+            if k.startswith(("title_", "description_")) and k.endswith(suffixes):
+                continue
+            if ui_lang != "en" and k in ("title", "description") and "%s_%s" % (k, ui_lang) in json_input:
+                continue
+            if k == "enum_loc":
+                trimmed[k] = dict((l, v[l]) for l in v if l == ui_lang)
+            else:
+                trimmed[k] = trim_schema(v, ui_lang)
+        if isinstance(trimmed.get("order"), list):
+            trimmed["order"] = [k for k in trimmed["order"] if k in trimmed]
+        return trimmed
+    elif isinstance(json_input, list):
+        return [trim_schema(item, ui_lang) for item in json_input]
+    return json_input
+
+
+class PreparedSchema(object):
+    """
+    A schema together with its JSON encoding and a strong ETag for it, and
+    a compiled validator unless the schema is trimmed.
+    """
+
+    def __init__(self, schema, trimmed=False):
+        # Not to be changed, since it is shared between requests
+        self.schema = schema
+        # Encoded as Flask encodes JSON responses, with sorted keys
+        self.json = json.dumps(schema, sort_keys=True).encode("utf-8")
+        self.etag = hashlib.sha1(self.json).hexdigest()
+        # Made after the encoding, since checking the defaults may fill in defaults of their own
+        self.validator = None if trimmed else CompiledValidator(schema)
+
+
+def prepared_schema(lang, mode, ui_lang=None):
+    """
+    The prepared schema for a language and text mode, optionally trimmed to
+    one UI language. Schemas of unknown languages and modes are made anew.
+    """
+    if ui_lang not in UI_LANGUAGES:
+        ui_lang = None
+    prepared = PREPARED_SCHEMAS.get((lang, mode, ui_lang))
+    if prepared is None:
+        schema = make_schema(lang, mode)
+        if ui_lang:
+            prepared = PreparedSchema(trim_schema(schema, ui_lang), trimmed=True)
+        else:
+            prepared = PreparedSchema(schema)
+    return prepared
+
+
+def prepare_schemas():
+    """Prepare the schemas of all languages and modes."""
+    prepared = {}
+    for lang in TOOL_DICT:
+        for mode in MODES:
+            schema = make_schema(lang, mode)
+            for ui_lang in UI_LANGUAGES:
+                prepared[(lang, mode, ui_lang)] = PreparedSchema(trim_schema(schema, ui_lang), trimmed=True)
+            prepared[(lang, mode, None)] = PreparedSchema(schema)
+    return prepared
+
+
+PREPARED_SCHEMAS = prepare_schemas()
+
+
 if __name__ == '__main__':
     # For testing purposes
     schema = make_schema("sv", "plain")
@@ -1,4 +1,6 @@
-from jsonschema import Draft3Validator
+from builtins import object
+from jsonschema import Draft3Validator, ValidationError, UnknownType, _flatten, _list, _types_msg
+import copy
 import logging
 import json
 
@@ -13,7 +15,170 @@ class DefaultValidator(Draft3Validator):
             if k not in instance and "default" in v:
                 default = v["default"]
                 super(DefaultValidator, self).validate(default, v)
-                instance[k] = default
+                # The schema is shared, so the instance gets its own copy
+                instance[k] = copy.deepcopy(default)
+
+
+class CompiledValidator(object):
+    """
+    A DefaultValidator for one schema, compiled once into a tree of closures.
+    Refs are resolved and the defaults checked when the validator is made,
+    so validating an instance only runs the closures. The errors, and the
+    defaults filled in, are the same as those of DefaultValidator.
+
+    The type, properties, enum, items and $ref keywords are compiled. The
+    other keywords are left to a DefaultValidator.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.fallback = DefaultValidator(schema)
+        # Compiled subschemas by id, so that shared and recursive ones are compiled once
+        self.compiled = {}
+        self.compilers = {
+            "type": self._compile_type,
+            "properties": self._compile_properties,
+            "enum": self._compile_enum,
+            "items": self._compile_items,
+            "ref": self._compile_ref,
+        }
+        self.check = self._compile(schema)
+
+    def iter_errors(self, instance):
+        """Lazily yield the errors in instance, filling in missing defaults."""
+        return self.check(instance)
+
+    def _compile(self, schema):
+        check = self.compiled.get(id(schema))
+        if check is not None:
+            return check
+        steps = []
+
+        def check(instance):
+            for keyword, step in steps:
+                for error in step(instance):
+                    if error.validator is None:
+                        error.validator = keyword
+                    yield error
+
+        self.compiled[id(schema)] = check
+        for k, v in schema.items():
+            name = k.lstrip("$")
+            if name in self.compilers:
+                steps.append((k, self.compilers[name](v, schema)))
+            elif getattr(self.fallback, "validate_%s" % name, None) is not None:
+                steps.append((k, self._fallback_step(name, v, schema)))
+        return check
+
+    def _fallback_step(self, name, value, schema):
+        validate = getattr(self.fallback, "validate_%s" % name)
+
+        def step(instance):
+            return validate(value, instance, schema) or ()
+        return step
+
+    def _is_type(self, type_name):
+        """A check for instances of a JSON Schema type, as Draft3Validator.is_type."""
+        if type_name not in self.fallback._types:
+            def is_unknown(instance):
+                raise UnknownType(type_name)
+            return is_unknown
+        python_type = self.fallback._types[type_name]
+        # bool inherits from int, so bools aren't integers unless bool is listed
+        flat = _flatten(python_type)
+        no_bool = int in flat and bool not in flat
+
+        def is_type(instance):
+            if no_bool and isinstance(instance, bool):
+                return False
+            return isinstance(instance, python_type)
+        return is_type
+
+    def _compile_type(self, types, schema):
+        types = _list(types)
+        checks = []
+        for t in types:
+            if self.fallback.is_type(t, "object"):
+                checks.append(self._is_valid(self._compile(t)))
+            elif self.fallback.is_type(t, "string"):
+                checks.append(self._is_type(t))
+
+        def step(instance):
+            for is_valid in checks:
+                if is_valid(instance):
+                    return
+            yield ValidationError(_types_msg(instance, types))
+        return step
+
+    @staticmethod
+    def _is_valid(check):
+        def is_valid(instance):
+            return next(check(instance), None) is None
+        return is_valid
+
+    def _compile_properties(self, properties, schema):
+        defaults = []
+        for k, v in properties.items():
+            if "default" not in v:
+                defaults.append((k, None, True))
+                continue
+            try:
+                # Checking a default may fill in defaults of its own
+                self.fallback.validate(v["default"], v)
+                defaults.append((k, v, True))
+            except Exception:
+                # Checked again, and raised, when the default is needed
+                defaults.append((k, v, False))
+        validate = self.fallback.validate
+
+        def step(instance):
+            for k, v, checked in defaults:
+                if k not in instance and v is not None:
+                    if not checked:
+                        validate(v["default"], v)
+                    instance[k] = copy.deepcopy(v["default"])
+            return ()
+        return step
+
+    def _compile_enum(self, enums, schema):
+        def step(instance):
+            if instance not in enums:
+                yield ValidationError("%r is not one of %r" % (instance, enums))
+        return step
+
+    def _compile_items(self, items, schema):
+        if isinstance(items, dict):
+            check = self._compile(items)
+
+            def step(instance):
+                if not isinstance(instance, list):
+                    return
+                for index, item in enumerate(instance):
+                    for error in check(item):
+                        error.path.append(index)
+                        yield error
+        elif isinstance(items, list) and all(isinstance(subschema, dict) for subschema in items):
+            checks = [self._compile(subschema) for subschema in items]
+
+            def step(instance):
+                if not isinstance(instance, list):
+                    return
+                for (index, item), check in zip(enumerate(instance), checks):
+                    for error in check(item):
+                        error.path.append(index)
+                        yield error
+        else:
+            return self._fallback_step("items", items, schema)
+        return step
+
+    def _compile_ref(self, ref, schema):
+        try:
+            resolved = self.fallback.resolver.resolve(self.schema, ref)
+        except Exception:
+            return self._fallback_step("ref", ref, schema)
+        if not isinstance(resolved, dict):
+            return self._fallback_step("ref", ref, schema)
+        return self._compile(resolved)
 
 
 def open_json(schema_file):
@@ -0,0 +1,15 @@
+#!/bin/sh
+
+#
+# Runs one annotation step and appends its start time, end time and command
+# line to a timing log. Used as the python interpreter of make when step
+# timing is enabled: time_step.sh <log file> <interpreter> <arguments>...
+#
+
+log=$1
+shift
+start=$(date +%s.%N)
+"$@"
+status=$?
+echo "$start $(date +%s.%N) $*" >> "$log"
+exit $status
@@ -0,0 +1,87 @@
+# Timing profile of the annotation steps of builds. When step timing is
+# enabled, make runs every annotation step through time_step.sh, which appends
+# the start and end time of the step to the timing log of the build. The
+# logs are aggregated per language and annotator when they are asked for.
+
+import json
+import logging
+import os
+
+from build import command_name
+from utils import get_build_directories, percentile
+
+log = logging.getLogger('pipeline.' + __name__)
+
+# Upper bounds (in seconds) of the histogram bins. A last bin takes the rest.
+HISTOGRAM_BOUNDS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500]
+
+PERCENTILES = [50, 90, 99]
+
+
+def read_step_times(path):
+    """Read a timing log. Return a list of (annotator, seconds)."""
+    steps = []
+    with open(path, 'r') as f:
+        for line in f:
+            parts = line.split(" ", 2)
+            if len(parts) < 3:
+                continue
+            name = command_name(parts[2])
+            try:
+                if name is not None:
+                    steps.append((name, float(parts[1]) - float(parts[0])))
+            except ValueError:
+                # A line cut short by a crash
+                continue
+    return steps
+
+
+def build_language(directory):
+    try:
+        with open(os.path.join(directory, 'settings.json'), 'r') as f:
+            return json.load(f).get('lang') or 'sv'
+    except (IOError, ValueError):
+        return 'sv'
+
+
+def histogram(values):
+    """Count the values in the bins of HISTOGRAM_BOUNDS."""
+    counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+    for v in values:
+        i = 0
+        while i < len(HISTOGRAM_BOUNDS) and v > HISTOGRAM_BOUNDS[i]:
+            i += 1
+        counts[i] += 1
+    return counts
+
+
+def aggregate(builds_dir):
+    """
+    Collect the step times of all builds. Return a dict from language to a
+    dict from annotator to a summary with the count, the total and maximum
+    time, the percentiles and the histogram.
+    """
+    times = {}
+    for d in get_build_directories(builds_dir):
+        directory = os.path.join(builds_dir, d)
+        try:
+            steps = read_step_times(os.path.join(directory, 'timings.log'))
+        except IOError:
+            continue
+        annotators = times.setdefault(build_language(directory), {})
+        for name, seconds in steps:
+            annotators.setdefault(name, []).append(seconds)
+
+    summary = {}
+    for lang, annotators in times.items():
+        summary[lang] = {}
+        for name, values in annotators.items():
+            values.sort()
+            summary[lang][name] = {
+                "count": len(values),
+                "total": sum(values),
+                "max": values[-1],
+                "percentiles": [(p, percentile(values, p)) for p in PERCENTILES],
+                "histogram": histogram(values),
+            }
+    return summary
@@ -0,0 +1,140 @@
+# Removal of build directories in the background. A directory is first
+# renamed into the trash directory, which is atomic and fast, so that it is
+# gone from builds_dir at once. The trashed directories are then deleted by a
+# background thread, in deletion jobs. The progress of every job is written to
+# a file in the trash directory, so that any worker process can report it.
+
+from builtins import object
+from queue import Queue
+from threading import Lock, Thread
+import errno
+import json
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+
+from utils import mkdir
+try:
+    from config import Config
+except ImportError:
+    from config_default import Config
+
+log = logging.getLogger('pipeline.' + __name__)
+
+# The progress of a job is written after every this many directories
+PROGRESS_INTERVAL = 100
+
+# Seconds that the state of a finished job is kept
+JOB_KEEP = 7 * 24 * 60 * 60
+
+JOB_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+class Trash(object):
+    """Moves directories to the trash, and deletes them in background jobs."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.jobs_dir = os.path.join(directory, "jobs")
+        mkdir(self.jobs_dir)
+        self.queue = Queue()
+        self.lock = Lock()
+        self.thread = None
+
+    def move(self, path):
+        """Rename path into the trash. Return the trashed path, or None if path does not exist."""
+        target = os.path.join(self.directory, "%s.%s" % (os.path.basename(path), uuid.uuid4().hex[:8]))
+        try:
+            os.rename(path, target)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        return target
+
+    def delete(self, paths):
+        """Start a job that deletes the trashed paths. Return the job id."""
+        job_id = uuid.uuid4().hex
+        job = {"id": job_id, "state": "queued", "directories": len(paths), "deleted": 0,
+               "created": time.time(), "finished": None}
+        self._write_job(job)
+        self.queue.put((job, paths))
+        self._start()
+        log.info("Deletion job %s: %d directories", job_id, len(paths))
+        return job_id
+
+    def job(self, job_id):
+        """The state of a job, as a dict, or None if there is no such job."""
+        if not JOB_ID.match(job_id):
+            return None
+        try:
+            with open(os.path.join(self.jobs_dir, job_id + ".json"), "r") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def empty(self):
+        """
+        Start a job that deletes everything in the trash, e.g. what was left
+        when a process died. Return the job id, or None if the trash is empty.
+        """
+        if not os.path.isdir(self.directory):
+            return None
+        paths = [os.path.join(self.directory, d) for d in os.listdir(self.directory) if d != "jobs"]
+        return self.delete(paths) if paths else None
+
+    def _write_job(self, job):
+        path = os.path.join(self.jobs_dir, job["id"] + ".json")
+        tmp_path = "%s.%s.tmp" % (path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(job, f)
+        os.rename(tmp_path, path)
+
+    def _prune_jobs(self):
+        """Remove the states of jobs that finished long ago."""
+        now = time.time()
+        for f in os.listdir(self.jobs_dir):
+            path = os.path.join(self.jobs_dir, f)
+            try:
+                if now - os.path.getmtime(path) > JOB_KEEP:
+                    os.remove(path)
+            except OSError:
+                continue
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self._work, name="trash")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _work(self):
+        while True:
+            job, paths = self.queue.get()
+            try:
+                self._run_job(job, paths)
+                self._prune_jobs()
+            except:
+                log.exception("Deletion job %s failed", job["id"])
+
+    def _run_job(self, job, paths):
+        job["state"] = "running"
+        self._write_job(job)
+        t0 = time.time()
+        for path in paths:
+            # Another process may be deleting the same leftovers
+            shutil.rmtree(path, ignore_errors=True)
+            job["deleted"] += 1
+            if job["deleted"] % PROGRESS_INTERVAL == 0:
+                self._write_job(job)
+        job["state"] = "done"
+        job["finished"] = time.time()
+        self._write_job(job)
+        log.info("Deletion job %s: deleted %d directories in %.2f seconds",
+                 job["id"], job["deleted"], time.time() - t0)
+
+
+trash = Trash(Config.trash_dir)
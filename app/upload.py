@@ -0,0 +1,100 @@
+# Spooling of uploaded files to disk. The files are written in chunks to a
+# temporary directory and hashed while they arrive, so that an upload is never
+# held in memory as a whole. When the build hash is known, the directory
+# becomes the original directory of the build.
+
+from builtins import object
+import codecs
+import hashlib
+import logging
+import os
+import time
+import uuid
+
+from blob_store import blob_store
+from utils import mkdir, rmdir, UTF8
+try:
+    from config import Config
+except ImportError:
+    from config_default import Config
+
+log = logging.getLogger('pipeline.' + __name__)
+
+CHUNK_SIZE = 64 * 1024
+
+
+class UploadSpool(object):
+    """
+    The uploaded files of one request.
+
+    The build hash is the same as the hash of the joined texts, the makefile
+    and the file names that was used before uploads were spooled, so
+    existing builds keep their hashes.
+    """
+
+    def __init__(self):
+        self.directory = os.path.join(Config.incoming_dir, uuid.uuid4().hex)
+        mkdir(self.directory)
+        self.names = []
+        self.text_hashes = {}
+        self.hasher = hashlib.sha1()
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, stream):
+        """Write the file name.xml from stream, hashing it on the way."""
+        if self.names:
+            # The texts used to be joined with newlines before hashing
+            self.hasher.update(b"\n")
+        text_hasher = hashlib.sha1()
+        decoder = codecs.getincrementaldecoder(UTF8)()
+        with open(os.path.join(self.directory, name + ".xml"), "wb") as f:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                # Refuse files that are not UTF-8, like before
+                decoder.decode(chunk)
+                self.hasher.update(chunk)
+                text_hasher.update(chunk)
+                f.write(chunk)
+        decoder.decode(b"", final=True)
+        self.names.append(name)
+        self.text_hashes[name] = text_hasher.hexdigest()
+
+    def build_hash(self, makefile_contents):
+        """The hash of the texts together with the makefile and the file names."""
+        hasher = self.hasher.copy()
+        hasher.update(makefile_contents.encode(UTF8))
+        hasher.update(" ".join(self.names).encode(UTF8))
+        return hasher.hexdigest()
+
+    def move_to(self, original_dir):
+        """Make the spooled files the original files of a build."""
+        if os.path.exists(original_dir):
+            # Written by an earlier incarnation of the build, with the same contents
+            log.info("Original files exist and are not rewritten: %s", original_dir)
+            self.discard()
+        elif blob_store is not None:
+            mkdir(original_dir)
+            # A name that was uploaded twice is one file, written by the last upload
+            for name in sorted(set(self.names)):
+                blob_store.link_file(self.text_hashes[name], os.path.join(original_dir, name + ".xml"),
+                                     os.path.join(self.directory, name + ".xml"))
+            self.discard()
+        else:
+            os.rename(self.directory, original_dir)
+
+    def discard(self):
+        """Remove the spooled files."""
+        rmdir(self.directory)
+
+
+def remove_stale_uploads(max_age):
+    """Remove spooled uploads that are older than max_age seconds, e.g. after a crash."""
+    if not os.path.isdir(Config.incoming_dir):
+        return
+    now = time.time()
+    for d in os.listdir(Config.incoming_dir):
+        path = os.path.join(Config.incoming_dir, d)
+        if now - os.path.getmtime(path) > max_age:
+            log.info("Removing stale upload %s", d)
+            rmdir(path)
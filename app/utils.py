@@ -51,7 +51,15 @@ ERROR_MSG = {
     "no_result": "No result found. Something went wrong in the corpus pipeline.",
     "empty_input": "No input was found.",
     "no_files": "No files provided for upload.",
-    "make_error": "Error occurred while running make."
+    "not_text": "The text is not a string.",
+    "not_text_list": "The texts must be a JSON list of strings.",
+    "too_many_texts": "Too many texts in one batch.",
+    "make_error": "Error occurred while running make.",
+    "queue_full": "The server is busy. Please try again later.",
+    "disk_full": "The server is out of disk space. Please try again later.",
+    "cancelled": "The build was cancelled.",
+    "timeout": "The build was stopped because it took too long.",
+    "abandoned": "The build was stopped because nobody was waiting for it."
 }
 
 UTF8 = "UTF-8"
@@ -105,6 +113,12 @@ def get_build_directories(builds_dir):
     return [d for d in dirlist if is_sha1(d)]
 
 
+def percentile(sorted_values, p):
+    """The p:th percentile of a sorted list, by the nearest rank method."""
+    rank = int(round(p / 100.0 * len(sorted_values) + 0.5))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
 def make_hash(*texts):
     """
     The text is hashed together with its makefile because the built corpus
@@ -121,9 +135,12 @@ def make(settings):
     """
     log.info("Calling /usr/bin/make %s" % ' '.join(settings))
     # return subprocess.check_output(['/usr/bin/make'] + settings)
+    # make gets a process group of its own, so that it can be killed with
+    # everything it has started
     return Popen(['/usr/bin/make'] + settings,
                  shell=False, close_fds=False,
-                 stdin=None, stdout=PIPE, stderr=PIPE)
+                 stdin=None, stdout=PIPE, stderr=PIPE,
+                 start_new_session=True)
 
 
 def mkdir(d):